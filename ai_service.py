@@ -1,44 +1,89 @@
+import io
 import os
 import re
+import time
+import asyncio
 import logging
 import json
 from google import genai
 from google.genai import types
-from duckduckgo_search import DDGS
 
 # Импортируем ваши новые файлы
 from models import Proposal 
-from boiler_catalog import BOILERS
+from catalog_engine import engine
+from price_cache import get_market_price
+import generation_cache
+import media_store
+from json_stream import IncrementalJSONObject
+from model_router import router, hedge_delay_from_env
+from async_runtime import upstream
 
 logger = logging.getLogger(__name__)
 
+# Кандидаты для генерации КП; порядок — предпочтение, пока у роутера нет статистики.
+# Для фото/голоса нужны мультимодальные модели.
+TEXT_MODELS = os.getenv("AI_TEXT_MODELS", "gemma-3-27b-it,gemini-2.5-flash").split(",")
+MEDIA_MODELS = os.getenv("AI_MEDIA_MODELS", "gemini-2.5-flash").split(",")
+# Генерация КП идет десятки секунд, а хедж — вторая полная платная генерация: по умолчанию выключен
+PROPOSAL_HEDGE_DELAY = hedge_delay_from_env("AI_PROPOSAL_HEDGE_DELAY")
+
+def find_boiler_candidates(area: int, k: int = 3, **filters) -> list[dict]:
+    """
+    RAG-подбор: top-k котлов из каталога, закрывающих теплопотери площади.
+    filters — доп. критерии CatalogIndex.query (type, circuits, protocol, max_price, min_efficiency).
+    """
+    required_power = (area / 10) * 1.2 # +20% запаса
+    return engine.query("boiler", min_power=required_power, k=k, **filters)
+
 def find_best_boiler(area: int) -> dict:
     """Простая логика RAG: подбор реального котла из базы по площади"""
-    required_power = (area / 10) * 1.2 # +20% запаса
-    
-    # Ищем подходящий котел, отсортировав каталог по мощности
-    suitable_boilers = sorted([b for b in BOILERS if b['power'] >= required_power], key=lambda x: x['power'])
-    
-    if suitable_boilers:
-        return suitable_boilers[0] # Берем минимально подходящий
-    return BOILERS[-1] # Если дом огромный, берем самый мощный из базы
+    candidates = find_boiler_candidates(area, k=1)
+    if candidates:
+        return candidates[0] # Берем минимально подходящий
+    return engine.index("boiler").most_powerful() # Если дом огромный, берем самый мощный из базы
 
 def search_market_price(model_name: str) -> str:
-    """Поиск актуальной цены в интернете через DuckDuckGo (Агентная логика)"""
+    """Актуальная цена из интернета (DuckDuckGo) через персистентный TTL-кэш"""
+    return get_market_price(model_name)
+
+def _strip_markdown(text: str) -> str:
+    raw_json = text.strip()
+    if raw_json.startswith("```json"): raw_json = raw_json[7:]
+    elif raw_json.startswith("```"): raw_json = raw_json[3:]
+    if raw_json.endswith("```"): raw_json = raw_json[:-3]
+    return raw_json.strip()
+
+def _generate_streaming(client, model_name: str, contents: list, on_progress) -> dict | None:
+    """
+    Потоковая генерация: по мере того как модель дописывает поля верхнего уровня
+    (title, executive_summary, plans...), вызывается on_progress(поле, значение).
+    None — если поток оборвался или JSON не разобрался; тогда работает обычный цикл повторов.
+    """
+    parser = IncrementalJSONObject()
     try:
-        results = DDGS().text(f"купить котел {model_name} цена", max_results=3)
-        prices_context = "Найденные рыночные цены:\n"
-        for r in results:
-            prices_context += f"- {r.get('title')}: {r.get('body')}\n"
-        return prices_context
+        stream = client.models.generate_content_stream(
+            model=model_name,
+            contents=contents,
+            config=types.GenerateContentConfig(temperature=0.3)
+        )
+        for chunk in stream:
+            if not chunk.text:
+                continue
+            for field in parser.feed(chunk.text):
+                try:
+                    on_progress(field, parser.fields[field])
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка обработчика прогресса ({field}): {e}")
+        data = json.loads(_strip_markdown(parser.buffer))
+        logger.info("✅ Успешная потоковая AI-генерация!")
+        return data
+    except json.JSONDecodeError as e:
+        logger.warning(f"⚠️ Потоковый ответ — невалидный JSON, переходим на обычную генерацию: {e}")
     except Exception as e:
-        logger.warning(f"Ошибка поиска цены для {model_name}: {e}")
-        return "Не удалось получить актуальные цены, используйте цены из базы."
-
-def get_smart_proposal(prompt: str, media_path: str = None, media_type: str = "text") -> dict | None:
-    api_key = os.getenv("GOOGLE_API_KEY")
-    client = genai.Client(api_key=api_key)
+        logger.warning(f"⚠️ Ошибка потоковой генерации, переходим на обычную: {e}")
+    return None
 
+def _select_boiler(prompt: str) -> dict:
     # 1. Пытаемся вытащить площадь из запроса (текстового)
     area = 100 # по умолчанию
     if prompt:
@@ -49,11 +94,9 @@ def get_smart_proposal(prompt: str, media_path: str = None, media_type: str = "t
     # 2. ПОДБОР ИЗ КАТАЛОГА (RAG)
     selected_boiler = find_best_boiler(area)
     logger.info(f"✅ Выбран котел из базы: {selected_boiler['model']} за {selected_boiler['price']} руб.")
+    return selected_boiler
 
-    # 2.5. АГЕНТСКИЙ ПОИСК ЦЕНЫ В РЕАЛЬНОМ ВРЕМЕНИ
-    real_time_prices = search_market_price(selected_boiler['model'])
-    logger.info(f"🔍 Рыночные данные по котлу получены.")
-
+def _build_contents(prompt: str, selected_boiler: dict, real_time_prices: str) -> list:
     # 3. Формируем умный промпт с передачей структуры JSON
     system_instruction = (
         "Ты — Главный инженер-теплотехник KOTEL.MSK.RU. Твоя задача — спроектировать котельную и составить смету.\n"
@@ -83,65 +126,253 @@ def get_smart_proposal(prompt: str, media_path: str = None, media_type: str = "t
         "}"
     )
 
-    contents = [system_instruction + f"\n\nЗАПРОС ОТ МЕНЕДЖЕРА: {prompt}"]
-    model_name = 'gemma-3-27b-it'
+    return [system_instruction + f"\n\nЗАПРОС ОТ МЕНЕДЖЕРА: {prompt}"]
+
+def _has_media(media_key: str, media_type: str) -> bool:
+    return bool(media_key and media_type in ["photo", "voice"])
+
+def _generation_cache_key(prompt: str, selected_boiler: dict, real_time_prices: str, media_key: str, has_media: bool) -> str:
+    """КЭШ ГЕНЕРАЦИЙ: тот же вход (ТЗ, котел, цены, модели, медиа) -> тот же КП"""
+    # Ключ медиа — это уже sha256 содержимого, перечитывать файл не нужно
+    media_digest = media_store.digest(media_key) if has_media else None
+    intended_models = ",".join(MEDIA_MODELS if has_media else TEXT_MODELS)
+    return generation_cache.make_key(prompt, selected_boiler['model'], real_time_prices, intended_models, media_digest)
+
+def _parse_response_text(text: str) -> dict:
+    if not text:
+        raise json.JSONDecodeError("пустой ответ модели", "", 0)
+    # Срезаем маркдаун и пытаемся распарсить
+    return json.loads(_strip_markdown(text))
+
+def _media_part(client, media_key: str) -> types.Part:
+    """
+    Медиа для Gemini по ключу из media_store. Файл с тем же содержимым загружается
+    в Files API один раз: ссылка на него кэшируется по хэшу на GEMINI_FILE_TTL.
+    """
+    cached = media_store.get_gemini_file(media_key)
+    if cached:
+        logger.info(f"⚡ Медиа уже загружено в Gemini ({media_store.digest(media_key)[:12]})")
+        return types.Part.from_uri(file_uri=cached["uri"], mime_type=cached["mime_type"])
+    data = media_store.get(media_key)
+    if data is None:
+        raise FileNotFoundError(f"Медиа {media_key} не найдено в хранилище")
+    logger.info(f"📤 Загрузка медиафайла: {media_key}")
+    uploaded = client.files.upload(
+        file=io.BytesIO(data),
+        config=types.UploadFileConfig(mime_type=media_store.mime_type(media_key))
+    )
+    media_store.save_gemini_file(media_key, uploaded.uri, uploaded.mime_type)
+    return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type)
+
+async def _amedia_part(client, media_key: str) -> types.Part:
+    cached = await asyncio.to_thread(media_store.get_gemini_file, media_key)
+    if cached:
+        logger.info(f"⚡ Медиа уже загружено в Gemini ({media_store.digest(media_key)[:12]})")
+        return types.Part.from_uri(file_uri=cached["uri"], mime_type=cached["mime_type"])
+    data = await asyncio.to_thread(media_store.get, media_key)
+    if data is None:
+        raise FileNotFoundError(f"Медиа {media_key} не найдено в хранилище")
+    logger.info(f"📤 Загрузка медиафайла: {media_key}")
+    async with upstream("gemini"):
+        uploaded = await client.aio.files.upload(
+            file=io.BytesIO(data),
+            config=types.UploadFileConfig(mime_type=media_store.mime_type(media_key))
+        )
+    await asyncio.to_thread(media_store.save_gemini_file, media_key, uploaded.uri, uploaded.mime_type)
+    return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type)
+
+def get_smart_proposal(prompt: str, media_key: str = None, media_type: str = "text", use_cache: bool = True,
+                       on_progress=None, on_cache_hit=None) -> dict | None:
+    """
+    on_progress(поле, значение) — необязательный колбэк живого прогресса: с ним КП
+    генерируется потоково, и вызывающий видит разделы до окончания генерации.
+    on_cache_hit() вызывается, если КП отдано из кэша генераций без вызова модели.
+    """
+    api_key = os.getenv("GOOGLE_API_KEY")
+    client = genai.Client(api_key=api_key)
+
+    selected_boiler = _select_boiler(prompt)
 
-    # Работа с медиа
-    uploaded_file = None
-    if media_path and media_type in ["photo", "voice"] and os.path.exists(media_path):
+    # 2.5. АГЕНТСКИЙ ПОИСК ЦЕНЫ В РЕАЛЬНОМ ВРЕМЕНИ
+    real_time_prices = search_market_price(selected_boiler['model'])
+    logger.info(f"🔍 Рыночные данные по котлу получены.")
+
+    # 3. Формируем умный промпт с передачей структуры JSON
+    contents = _build_contents(prompt, selected_boiler, real_time_prices)
+    models = TEXT_MODELS
+    has_media = _has_media(media_key, media_type)
+
+    # 3.5. КЭШ ГЕНЕРАЦИЙ (use_cache=False — не читаем, но свежий результат заменит запись)
+    cache_key = _generation_cache_key(prompt, selected_boiler, real_time_prices, media_key, has_media)
+    if use_cache:
+        cached = generation_cache.get(cache_key)
+        if cached is not None:
+            if on_cache_hit:
+                on_cache_hit()
+            return cached
+
+    # Работа с медиа: файлы в Gemini не удаляем — их переиспользуют повторы с тем же содержимым
+    if has_media:
         try:
-            logger.info(f"📤 Загрузка медиафайла: {media_path}")
-            uploaded_file = client.files.upload(file=media_path)
-            contents.insert(0, uploaded_file)
-            # Для мультимодальных задач используем gemini-2.5-flash
-            model_name = 'gemini-2.5-flash'
-            logger.info(f"🔄 Переключение на модель {model_name} для обработки {media_type}")
+            contents.insert(0, _media_part(client, media_key))
+            # Для мультимодальных задач — только мультимодальные модели
+            models = MEDIA_MODELS
+            logger.info(f"🔄 Переключение на модели {', '.join(models)} для обработки {media_type}")
         except Exception as e:
             logger.error(f"❌ Ошибка загрузки медиа: {e}")
+            cache_key = None # Генерация без медиа не должна попасть в кэш под ключом с медиа
+
+    if on_progress is not None:
+        # Поток не хеджируется: берем самую быструю здоровую модель и отдаем замер роутеру
+        model_name = router.pick(models)
+        started = time.perf_counter()
+        data = _generate_streaming(client, model_name, contents, on_progress)
+        router.record(model_name, time.perf_counter() - started, data is not None)
+        if data is not None:
+            if cache_key:
+                generation_cache.put(cache_key, data)
+            return data
 
-    # Пробуем сгенерировать до 3 раз (Self-Healing Loop)
+    def generate(model_name: str) -> dict:
+        response = client.models.generate_content(
+            model=model_name,
+            contents=contents,
+            config=types.GenerateContentConfig(temperature=0.3)
+        )
+        return _parse_response_text(response.text)
+
+    # Пробуем сгенерировать до 3 раз (Self-Healing Loop); внутри попытки роутер выбирает
+    # самую быструю здоровую модель и хеджирует ее второй, если та медленнее своего p95
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            response = client.models.generate_content(
+            data = router.call(models, generate, hedge_delay=PROPOSAL_HEDGE_DELAY)
+            logger.info(f"✅ Успешная AI-генерация с {attempt + 1} попытки!")
+
+            if cache_key:
+                generation_cache.put(cache_key, data)
+            return data
+            
+        except json.JSONDecodeError as e:
+            logger.warning(f"⚠️ AI выдал невалидный JSON (попытка {attempt + 1}/{max_retries}): {e}")
+            if attempt == max_retries - 1:
+                logger.error("❌ Фатальный сбой: AI так и не смог выдать правильный JSON.")
+                return None
+        except Exception as e:
+            logger.error(f"❌ Ошибка API Google: {e}")
+            return None
+            
+    return None
+
+# --- ASYNC-РЕЖИМ ВОРКЕРА (ASYNC_WORKER_MODE) ---
+# Все корутины ниже выполняются на общем loop процесса (async_runtime), поэтому один
+# клиент GenAI с его пулом соединений делят все генерации процесса.
+_aio_client: genai.Client | None = None
+_aio_client_pid: int | None = None
+
+def _get_aio_client() -> genai.Client:
+    global _aio_client, _aio_client_pid
+    if _aio_client is None or _aio_client_pid != os.getpid():
+        _aio_client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+        _aio_client_pid = os.getpid()
+    return _aio_client
+
+async def _agenerate_streaming(client, model_name: str, contents: list, on_progress) -> dict | None:
+    """Асинхронный вариант _generate_streaming; синхронный on_progress уходит в поток, не блокируя loop."""
+    parser = IncrementalJSONObject()
+    try:
+        async with upstream("gemini"):
+            stream = await client.aio.models.generate_content_stream(
+                model=model_name,
+                contents=contents,
+                config=types.GenerateContentConfig(temperature=0.3)
+            )
+            async for chunk in stream:
+                if not chunk.text:
+                    continue
+                for field in parser.feed(chunk.text):
+                    try:
+                        await asyncio.to_thread(on_progress, field, parser.fields[field])
+                    except Exception as e:
+                        logger.warning(f"⚠️ Ошибка обработчика прогресса ({field}): {e}")
+        data = json.loads(_strip_markdown(parser.buffer))
+        logger.info("✅ Успешная потоковая AI-генерация!")
+        return data
+    except json.JSONDecodeError as e:
+        logger.warning(f"⚠️ Потоковый ответ — невалидный JSON, переходим на обычную генерацию: {e}")
+    except Exception as e:
+        logger.warning(f"⚠️ Ошибка потоковой генерации, переходим на обычную: {e}")
+    return None
+
+async def aget_smart_proposal(prompt: str, media_key: str = None, media_type: str = "text", use_cache: bool = True,
+                              on_progress=None, on_cache_hit=None) -> dict | None:
+    """
+    То же, что get_smart_proposal, но без блокировки потока: Gemini через client.aio,
+    поиск цены (синхронный DDGS) — в потоке под семафором duckduckgo.
+    """
+    client = _get_aio_client()
+    selected_boiler = _select_boiler(prompt)
+
+    async with upstream("duckduckgo"):
+        real_time_prices = await asyncio.to_thread(search_market_price, selected_boiler['model'])
+    logger.info(f"🔍 Рыночные данные по котлу получены.")
+
+    contents = _build_contents(prompt, selected_boiler, real_time_prices)
+    models = TEXT_MODELS
+    has_media = _has_media(media_key, media_type)
+
+    cache_key = _generation_cache_key(prompt, selected_boiler, real_time_prices, media_key, has_media)
+    if use_cache:
+        cached = await asyncio.to_thread(generation_cache.get, cache_key)
+        if cached is not None:
+            if on_cache_hit:
+                on_cache_hit()
+            return cached
+
+    if has_media:
+        try:
+            contents.insert(0, await _amedia_part(client, media_key))
+            models = MEDIA_MODELS
+            logger.info(f"🔄 Переключение на модели {', '.join(models)} для обработки {media_type}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки медиа: {e}")
+            cache_key = None
+
+    async def finish(data: dict | None) -> dict | None:
+        if data is not None and cache_key:
+            await asyncio.to_thread(generation_cache.put, cache_key, data)
+        return data
+
+    if on_progress is not None:
+        model_name = router.pick(models)
+        started = time.perf_counter()
+        data = await _agenerate_streaming(client, model_name, contents, on_progress)
+        router.record(model_name, time.perf_counter() - started, data is not None)
+        if data is not None:
+            return await finish(data)
+
+    async def generate(model_name: str) -> dict:
+        async with upstream("gemini"):
+            response = await client.aio.models.generate_content(
                 model=model_name,
                 contents=contents,
                 config=types.GenerateContentConfig(temperature=0.3)
             )
+        return _parse_response_text(response.text)
 
-            if response.text:
-                raw_json = response.text.strip()
-                # Срезаем маркдаун
-                if raw_json.startswith("```json"): raw_json = raw_json[7:]
-                elif raw_json.startswith("```"): raw_json = raw_json[3:]
-                if raw_json.endswith("```"): raw_json = raw_json[:-3]
-                
-                # Пытаемся распарсить
-                data = json.loads(raw_json.strip())
-                logger.info(f"✅ Успешная AI-генерация с {attempt + 1} попытки!")
-                
-                # Очистка загруженного файла из Google API (опционально, но полезно)
-                if uploaded_file:
-                    try:
-                        client.files.delete(name=uploaded_file.name)
-                    except:
-                        pass
-                        
-                return data
-                
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            data = await router.acall(models, generate, hedge_delay=PROPOSAL_HEDGE_DELAY)
+            logger.info(f"✅ Успешная AI-генерация с {attempt + 1} попытки!")
+            return await finish(data)
         except json.JSONDecodeError as e:
             logger.warning(f"⚠️ AI выдал невалидный JSON (попытка {attempt + 1}/{max_retries}): {e}")
             if attempt == max_retries - 1:
                 logger.error("❌ Фатальный сбой: AI так и не смог выдать правильный JSON.")
-                if uploaded_file:
-                    try: client.files.delete(name=uploaded_file.name)
-                    except: pass
-                return None
+                return await finish(None)
         except Exception as e:
             logger.error(f"❌ Ошибка API Google: {e}")
-            if uploaded_file:
-                try: client.files.delete(name=uploaded_file.name)
-                except: pass
-            return None
-            
+            return await finish(None)
+
     return None
@@ -0,0 +1,114 @@
+import json
+import asyncio
+import logging
+
+import aiosqlite
+
+from database import (
+    DB_PATH, SQLITE_PRAGMAS, STATEMENT_CACHE_SIZE, ANALYTICS_SQL, PLAN_CLICKS_SQL, analytics_from_rows
+)
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный слой поверх того же файла БД для FastAPI: запросы выполняются в
+# выделенном потоке aiosqlite и не блокируют event loop uvicorn.
+_conn: aiosqlite.Connection | None = None
+# Первые одновременные запросы ждут одно открытие, а не открывают каждый свое соединение
+_conn_lock = asyncio.Lock()
+
+
+async def get_connection() -> aiosqlite.Connection:
+    global _conn
+    if _conn is not None:
+        return _conn
+    async with _conn_lock:
+        if _conn is None:
+            conn = await aiosqlite.connect(DB_PATH, timeout=5, cached_statements=STATEMENT_CACHE_SIZE)
+            for pragma in SQLITE_PRAGMAS:
+                await conn.execute(pragma)
+            _conn = conn
+            logger.info("🗄️ Асинхронное соединение с БД открыто")
+    return _conn
+
+
+async def close_connection():
+    global _conn
+    async with _conn_lock:
+        if _conn is not None:
+            await _conn.close()
+            _conn = None
+
+
+async def get_proposal_data(proposal_id: str) -> dict | None:
+    """Асинхронная версия database.get_proposal_data."""
+    conn = await get_connection()
+    async with conn.execute("SELECT proposal_data FROM proposals WHERE id = ?", (proposal_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row and row[0]:
+        return json.loads(row[0])
+    return None
+
+
+async def get_proposal_version(proposal_id: str) -> tuple[int, str] | None:
+    """(version, время изменения) готового КП — дешевый запрос для проверки кэша страниц."""
+    conn = await get_connection()
+    async with conn.execute(
+        "SELECT version, COALESCE(updated_at, created_at) FROM proposals WHERE id = ? AND proposal_data IS NOT NULL",
+        (proposal_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    return (row[0], row[1]) if row else None
+
+
+async def get_proposal_recalc_info(proposal_id: int) -> dict | None:
+    """Владелец, клиент и номер последнего примененного ТЗ — для постановки пересчета из /ai."""
+    conn = await get_connection()
+    async with conn.execute(
+        "SELECT user_id, client, COALESCE(spec_seq, 0) FROM proposals WHERE id = ?",
+        (proposal_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        return None
+    return {"user_id": row[0], "client": row[1], "spec_seq": row[2]}
+
+
+async def get_proposal_page_data(proposal_id: str) -> dict | None:
+    """Все, что нужно для рендера страницы КП: клиент, ТЗ, JSON и версия."""
+    conn = await get_connection()
+    async with conn.execute(
+        "SELECT client, task, proposal_data, version, COALESCE(updated_at, created_at) FROM proposals WHERE id = ?",
+        (proposal_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if not row or not row[2]:
+        return None
+    return {
+        "client": row[0],
+        "task": row[1],
+        "proposal_data": json.loads(row[2]),
+        "version": row[3],
+        "updated_at": row[4],
+    }
+
+
+async def get_cache_counters() -> dict:
+    """Асинхронная версия database.get_cache_counters."""
+    conn = await get_connection()
+    result = {}
+    async with conn.execute("SELECT cache, counter, value FROM cache_counters") as cursor:
+        async for name, counter, value in cursor:
+            result.setdefault(name, {})[counter] = value
+    return result
+
+
+async def get_proposal_analytics(proposal_id: int) -> dict | None:
+    """Асинхронная версия database.get_proposal_analytics."""
+    conn = await get_connection()
+    async with conn.execute(ANALYTICS_SQL, (proposal_id,)) as cursor:
+        row = await cursor.fetchone()
+    plan_rows = []
+    if row:
+        async with conn.execute(PLAN_CLICKS_SQL, (proposal_id,)) as cursor:
+            plan_rows = await cursor.fetchall()
+    return analytics_from_rows(row, plan_rows)
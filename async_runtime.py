@@ -0,0 +1,73 @@
+import os
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Сколько одновременных запросов процесс отправляет в каждый внешний сервис из корутин генерации.
+# Генерации ждут в основном Gemini, поэтому его лимит самый широкий. Telegram и GitHub
+# вызываются синхронно из задач доставки и публикации: их ограничивают RateLimiter
+# telegram_client и отдельная очередь publish, а не эти семафоры.
+UPSTREAM_LIMITS = {
+    "gemini": int(os.getenv("UPSTREAM_LIMIT_GEMINI", "32")),
+    "duckduckgo": int(os.getenv("UPSTREAM_LIMIT_DUCKDUCKGO", "4")),
+}
+
+
+class AsyncRuntime:
+    """
+    Один event loop на процесс в фоновом потоке. Celery-задачи (пул потоков)
+    отдают ему корутины и ждут результат: десятки генераций одного процесса
+    мультиплексируются на одном loop, а внешние сервисы защищены семафорами.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._thread = threading.Thread(target=self._run, name="async-runtime", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro, timeout: float | None = None):
+        """Выполняет корутину на общем loop и блокирует вызывающий поток до результата."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout)
+
+    def semaphore(self, upstream: str) -> asyncio.Semaphore:
+        # Вызывается только из корутин на self.loop, поэтому без блокировки
+        sem = self._semaphores.get(upstream)
+        if sem is None:
+            # Неизвестное имя — KeyError: лимит без записи в UPSTREAM_LIMITS не заведется молча
+            sem = self._semaphores[upstream] = asyncio.Semaphore(UPSTREAM_LIMITS[upstream])
+        return sem
+
+    def stats(self) -> dict:
+        return {
+            name: {"limit": UPSTREAM_LIMITS[name], "available": sem._value}
+            for name, sem in self._semaphores.items()
+        }
+
+
+_runtime: AsyncRuntime | None = None
+_runtime_pid: int | None = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime() -> AsyncRuntime:
+    """Runtime текущего процесса (после fork Celery поток loop не наследуется — создаем заново)."""
+    global _runtime, _runtime_pid
+    with _runtime_lock:
+        if _runtime is None or _runtime_pid != os.getpid():
+            _runtime = AsyncRuntime()
+            _runtime_pid = os.getpid()
+            logger.info("🔁 Запущен общий event loop процесса для асинхронных задач")
+        return _runtime
+
+
+def upstream(name: str) -> asyncio.Semaphore:
+    """`async with upstream("gemini"): ...` — ограничение параллелизма к внешнему сервису."""
+    return get_runtime().semaphore(name)
@@ -0,0 +1,60 @@
+"""
+Микробенчмарк рендера PDF: время на один КП без кэша шрифтов/стилей (как было —
+TTF парсится и стили собираются в каждом PDFGenerator) и с кэшем на процесс.
+
+Запуск: python bench_pdf.py [количество PDF]
+"""
+import os
+import sys
+import time
+import tempfile
+import statistics
+
+import pdf_generator
+from pdf_generator import generate_pdf
+
+SAMPLE_PROPOSAL = {
+    "executive_summary": "Котельная для частного дома 180 м2 с теплым полом и бойлером косвенного нагрева.",
+    "client_pain_points": ["Холодно на втором этаже", "Не хватает горячей воды"],
+    "plans": [
+        {
+            "name": name,
+            "description": "Комплектация под ключ",
+            "budget_items": [{"item": f"Позиция {i}", "price": f"{(i + 1) * 1000} руб."} for i in range(15)],
+            "total_price": "120 000 руб."
+        }
+        for name in ("Базовый", "Оптимальный", "Премиум")
+    ]
+}
+
+
+def _reset_process_caches():
+    pdf_generator._fonts_registered = False
+    pdf_generator.get_styles.cache_clear()
+
+
+def run(count: int, cold: bool) -> list[float]:
+    timings = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(count):
+            if cold:
+                _reset_process_caches()
+            filename = os.path.join(tmp, f"bench_{i}.pdf")
+            started = time.perf_counter()
+            generate_pdf(SAMPLE_PROPOSAL, filename, str(i))
+            timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    run(1, cold=False)  # прогрев импорта reportlab
+
+    for label, cold in (("до (без кэша)", True), ("после (кэш на процесс)", False)):
+        timings = run(count, cold)
+        print(f"{label:>24}: median {statistics.median(timings):7.1f} мс | "
+              f"mean {statistics.mean(timings):7.1f} мс | min {min(timings):7.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
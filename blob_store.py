@@ -0,0 +1,101 @@
+import os
+import time
+import logging
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Общее хранилище бинарных артефактов между узлами (PDF, медиа).
+# По умолчанию — Redis, который уже используется Celery; BLOB_STORE_DIR включает
+# локальную папку (один узел, тесты, локальная отладка).
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR")
+REDIS_URL = os.getenv("REDIS_URL")
+DEFAULT_TTL = 3600
+
+
+class RedisBlobStore:
+    def __init__(self, url: str, prefix: str = "blob:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def put(self, key: str, data: bytes, ttl: int = DEFAULT_TTL):
+        self.client.set(self.prefix + key, data, ex=ttl)
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(self.prefix + key)
+
+    def exists(self, key: str) -> bool:
+        return bool(self.client.exists(self.prefix + key))
+
+    def touch(self, key: str, ttl: int = DEFAULT_TTL) -> bool:
+        """Продлевает TTL существующего объекта; False — объекта нет."""
+        return bool(self.client.expire(self.prefix + key, ttl))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+
+class LocalBlobStore:
+    """Папка на диске. TTL проверяется при чтении по времени изменения файла."""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key.replace(":", "_").replace("/", "_")
+
+    def put(self, key: str, data: bytes, ttl: int = DEFAULT_TTL):
+        path = self._path(key)
+        # Пишем во временный файл и переименовываем — читатель не увидит половину файла
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        expires_at = time.time() + ttl
+        os.utime(path, (expires_at, expires_at))
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            if path.stat().st_mtime < time.time():
+                path.unlink(missing_ok=True)
+                return None
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key: str) -> bool:
+        path = self._path(key)
+        return path.exists() and path.stat().st_mtime >= time.time()
+
+    def touch(self, key: str, ttl: int = DEFAULT_TTL) -> bool:
+        if not self.exists(key):
+            return False
+        expires_at = time.time() + ttl
+        try:
+            os.utime(self._path(key), (expires_at, expires_at))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+
+_store = None
+
+
+def get_blob_store():
+    global _store
+    if _store is None:
+        if BLOB_STORE_DIR:
+            _store = LocalBlobStore(BLOB_STORE_DIR)
+        elif REDIS_URL:
+            _store = RedisBlobStore(REDIS_URL)
+        else:
+            raise RuntimeError("Не задан ни BLOB_STORE_DIR, ни REDIS_URL для хранилища артефактов")
+        logger.info(f"📦 Хранилище артефактов: {type(_store).__name__}")
+    return _store
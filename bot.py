@@ -12,8 +12,12 @@ from telegram.ext import (
 
 # Импорт для фоновых задач
 from celery_worker import task_generate_proposal
+import media_store
 # Утилиты для работы с БД, которые все еще нужны боту
-from database import init_db, save_proposal, get_user_history, get_stats
+from database import (
+    init_db, save_proposal, get_user_history, get_stats, get_proposal_analytics, get_proposal_source,
+    get_stage_timings
+)
 
 load_dotenv()
 
@@ -118,7 +122,7 @@ async def about_client(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 async def task_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # Определяем тип входных данных (текст, фото или голос)
-    media_path = None
+    media_key = None
     media_type = "text"
     task_text = ""
 
@@ -128,14 +132,15 @@ async def task_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         media_type = "photo"
         task_text = update.message.caption or "Анализ помещения по фото"
         photo_file = await update.message.photo[-1].get_file()
-        media_path = f"temp_{update.effective_user.id}_{photo_file.file_id}.jpg"
-        await photo_file.download_to_drive(media_path)
+        photo_bytes = await photo_file.download_as_bytearray()
+        # Кладем в общее хранилище по хэшу содержимого: воркер на любом узле прочитает его по ключу
+        media_key = await asyncio.to_thread(media_store.put, bytes(photo_bytes), ".jpg")
     elif update.message.voice:
         media_type = "voice"
         task_text = "Голосовое сообщение" # Текст будет распознан позже
         voice_file = await update.message.voice.get_file()
-        media_path = f"temp_{update.effective_user.id}_{voice_file.file_id}.ogg"
-        await voice_file.download_to_drive(media_path)
+        voice_bytes = await voice_file.download_as_bytearray()
+        media_key = await asyncio.to_thread(media_store.put, bytes(voice_bytes), ".ogg")
 
     context.user_data['task_info'] = task_text
     
@@ -150,15 +155,17 @@ async def task_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         task_text
     )
 
-    # Этап 2: Отправляем "тяжелую" задачу на генерацию в Celery, передавая chat_id и media.
-    task_generate_proposal.delay(proposal_id, client_name, task_text, chat_id, media_path, media_type)
-    
-    # Этап 3: Моментально отвечаем, что задача в работе. Результат пришлет воркер.
-    await update.message.reply_text(
+    # Этап 2: Моментально отвечаем, что задача в работе. Это сообщение воркер
+    # будет редактировать, показывая разделы КП по мере генерации.
+    progress_message = await update.message.reply_text(
         f"✅ Принято в работу! ID проекта: {proposal_id}\n\n"
         f"AI-генератор уже проектирует систему. "
         f"Готовый результат (WEB + PDF) придет в этот чат через 1-2 минуты."
     )
+
+    # Этап 3: Отправляем "тяжелую" задачу на генерацию в Celery, передавая chat_id, media и id сообщения прогресса.
+    task_generate_proposal.delay(proposal_id, client_name, task_text, chat_id, media_key, media_type,
+                                 progress_message_id=progress_message.message_id)
     
     # Завершаем диалог
     context.user_data.clear()
@@ -189,11 +196,82 @@ async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_chat_access(update): return
 
-    total = get_stats()
-    await update.message.reply_text(
-        f"📊 **Статистика системы**\n\n"
-        f"Всего КП создано: `{total}`"
-    , parse_mode='Markdown')
+    data = get_stats(update.effective_user.id)
+
+    def line(title, s):
+        avg = f"{s['avg_generation_ms'] / 1000:.1f} с" if s["avg_generation_ms"] else "—"
+        return (f"{title}: создано `{s['created']}`, ✅ `{s['succeeded']}` (⚡ из кэша `{s['cache_hits']}`), "
+                f"❌ `{s['failed']}`, ⏱️ `{avg}`\n")
+
+    text = "📊 **Статистика системы**\n\n"
+    text += line("Всего", data["total"])
+    text += line("Сегодня", data["today"])
+    text += line("Ваши КП", data["user"])
+    text += "\n**Последние 7 дней (создано КП):**\n"
+    for day, s in data["days"].items():
+        text += f"• {day[5:]}: `{s['created']}`\n"
+
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def analytics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await check_chat_access(update): return
+
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /analytics <ID КП>")
+        return
+
+    proposal_id = int(context.args[0])
+    data = get_proposal_analytics(proposal_id)
+    timings = get_stage_timings(proposal_id)
+    if not data and not timings:
+        await update.message.reply_text(f"По КП #{proposal_id} пока нет событий")
+        return
+
+    text = f"📈 **Аналитика КП #{proposal_id}**\n\n"
+    if data:
+        text += (
+            f"Открытий: `{data['opens']}`\n"
+            f"Глубина скролла: `{data['max_scroll_depth']}%`\n"
+            f"Время на тарифах: `{data['plans_view_seconds']} с`\n"
+            f"Вопросов AI: `{data['ai_questions']}` | Пересчетов: `{data['recalculations']}`\n"
+            f"Первый визит: `{(data['first_seen'] or '')[:16]}`\n"
+            f"Последний визит: `{(data['last_seen'] or '')[:16]}`\n"
+        )
+        if data["plans"]:
+            text += "\n**Тарифы:**\n"
+            for plan in data["plans"]:
+                text += f"• {plan['plan_name']}: кликов `{plan['clicks']}`, аванс `{plan['pay_clicks']}`\n"
+    else:
+        text += "Клиент еще не открывал КП\n"
+    if timings:
+        # Последний замер каждого этапа: generate, page, pdf, page_ready, deliver, total
+        text += "\n**Этапы генерации:**\n"
+        for stage, duration_ms in timings.items():
+            text += f"• {stage}: `{duration_ms / 1000:.1f} с`\n"
+
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def regenerate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Повторная генерация КП мимо кэша генераций — когда результат из кэша не устроил менеджера."""
+    if not await check_chat_access(update): return
+
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /regenerate <ID КП>")
+        return
+
+    proposal_id = int(context.args[0])
+    source = get_proposal_source(proposal_id)
+    if not source or source[0] != update.effective_user.id:
+        await update.message.reply_text(f"КП #{proposal_id} не найдено среди ваших")
+        return
+
+    _, client_name, task_text = source
+    progress_message = await update.message.reply_text(
+        f"🔁 Генерирую КП #{proposal_id} заново (без кэша). Результат придет в этот чат."
+    )
+    # Фото и голос в БД не хранятся: повторная генерация идет по текстовому ТЗ
+    task_generate_proposal.delay(proposal_id, client_name, task_text, update.effective_chat.id,
+                                 bypass_cache=True, progress_message_id=progress_message.message_id)
 
 
 def main() -> None: 
@@ -222,6 +300,8 @@ def main() -> None:
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("history", history))
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("analytics", analytics))
+    application.add_handler(CommandHandler("regenerate", regenerate))
     
     logger.info("🚀 Бот запущен (AI-CRM Mode)")
     application.run_polling()
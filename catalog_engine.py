@@ -0,0 +1,141 @@
+import time
+import bisect
+import logging
+from array import array
+from functools import lru_cache
+
+from boiler_catalog import BOILERS
+
+logger = logging.getLogger(__name__)
+
+# Ключи, по которым можно ранжировать выдачу. Для каждого при загрузке строится
+# отсортированный индекс: (ключ ранжирования, цена, -КПД) — тай-брейки одинаковые.
+RANK_KEYS = ("power", "price", "efficiency")
+
+
+class CatalogIndex:
+    """
+    Колоночное представление одного каталога (котлы, насосы, баки, гидрострелки).
+    Числовые поля лежат в array, строковые категории закодированы в небольшие
+    целые коды, а отсортированные индексы позволяют начинать просмотр сразу с
+    первой подходящей по мощности позиции и останавливаться после k совпадений.
+    """
+
+    def __init__(self, items: list[dict]):
+        self.items = list(items)
+        n = len(self.items)
+
+        self.power = array('d', (float(b.get("power") or 0) for b in self.items))
+        self.price = array('d', (float(b.get("price") or 0) for b in self.items))
+        self.efficiency = array('d', (float(b.get("efficiency") or 0) for b in self.items))
+        self.circuits = array('H', (int(b.get("circuits") or 0) for b in self.items))
+
+        self._type_names, self.type_codes = self._encode([b.get("type", "") for b in self.items])
+        self._protocol_names, self.protocol_codes = self._encode([b.get("protocol", "") for b in self.items])
+
+        # Отсортированные индексы по каждому ключу ранжирования
+        self.order = {
+            "power": array('I', sorted(range(n), key=lambda i: (self.power[i], self.price[i], -self.efficiency[i]))),
+            "price": array('I', sorted(range(n), key=lambda i: (self.price[i], -self.efficiency[i]))),
+            "efficiency": array('I', sorted(range(n), key=lambda i: (-self.efficiency[i], self.price[i]))),
+        }
+        # Отсортированные значения мощности для бинарного поиска нижней границы
+        self.sorted_power = array('d', (self.power[i] for i in self.order["power"]))
+        self.max_power_idx = self.order["power"][-1] if n else None
+
+    @staticmethod
+    def _encode(values: list[str]) -> tuple[list[str], array]:
+        names, index = [], {}
+        codes = array('H')
+        for value in values:
+            value = value or ""
+            if value not in index:
+                index[value] = len(names)
+                names.append(value)
+            codes.append(index[value])
+        return names, codes
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _match_codes(names: tuple[str, ...], needle: str) -> frozenset:
+        """Коды категорий, содержащих подстроку (например, 'OpenTherm' в 'Modbus / OpenTherm')."""
+        needle = needle.lower()
+        return frozenset(code for code, name in enumerate(names) if needle in name.lower())
+
+    def query(self, min_power: float = 0, max_power: float | None = None, type: str | None = None,
+              circuits: int | None = None, protocol: str | None = None, max_price: float | None = None,
+              min_efficiency: float | None = None, k: int = 5, rank_by: str = "power") -> list[dict]:
+        """Возвращает до k позиций, удовлетворяющих всем фильтрам, в порядке ранжирования."""
+        if rank_by not in RANK_KEYS:
+            raise ValueError(f"Неизвестный ключ ранжирования: {rank_by}")
+
+        type_codes = self._match_codes(tuple(self._type_names), type) if type else None
+        protocol_codes = self._match_codes(tuple(self._protocol_names), protocol) if protocol else None
+        if (type_codes is not None and not type_codes) or (protocol_codes is not None and not protocol_codes):
+            return []
+
+        if rank_by == "power":
+            # Все, что левее bisect, заведомо слабее требуемого — даже не смотрим
+            order = self.order["power"]
+            start = bisect.bisect_left(self.sorted_power, min_power)
+        else:
+            order = self.order[rank_by]
+            start = 0
+
+        power, price, efficiency, circ = self.power, self.price, self.efficiency, self.circuits
+        result = []
+        for pos in range(start, len(order)):
+            i = order[pos]
+            p = power[i]
+            if p < min_power:
+                continue
+            if max_power is not None and p > max_power:
+                if rank_by == "power":
+                    break  # дальше только мощнее
+                continue
+            if max_price is not None and price[i] > max_price:
+                if rank_by == "price":
+                    break  # дальше только дороже
+                continue
+            if min_efficiency is not None and efficiency[i] < min_efficiency:
+                if rank_by == "efficiency":
+                    break  # дальше только ниже КПД
+                continue
+            if circuits is not None and circ[i] != circuits:
+                continue
+            if type_codes is not None and self.type_codes[i] not in type_codes:
+                continue
+            if protocol_codes is not None and self.protocol_codes[i] not in protocol_codes:
+                continue
+            result.append(self.items[i])
+            if len(result) >= k:
+                break
+        return result
+
+    def most_powerful(self) -> dict | None:
+        return self.items[self.max_power_idx] if self.max_power_idx is not None else None
+
+
+class CatalogEngine:
+    """Реестр индексов по категориям оборудования: 'boiler', 'pump', 'tank', 'separator'."""
+
+    def __init__(self):
+        self._indexes: dict[str, CatalogIndex] = {}
+
+    def load(self, category: str, items: list[dict]):
+        started = time.perf_counter()
+        self._indexes[category] = CatalogIndex(items)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"📚 Каталог '{category}' загружен: {len(items)} SKU за {elapsed_ms:.1f} мс")
+
+    def index(self, category: str) -> CatalogIndex:
+        if category not in self._indexes:
+            raise KeyError(f"Каталог '{category}' не загружен")
+        return self._indexes[category]
+
+    def query(self, category: str, **filters) -> list[dict]:
+        return self.index(category).query(**filters)
+
+
+engine = CatalogEngine()
+engine.load("boiler", BOILERS)
@@ -1,10 +1,25 @@
 import os
+import time
+import uuid
+import threading
 import requests
-from celery import Celery
-from ai_service import get_smart_proposal
+from contextlib import contextmanager
+from celery import Celery, chord, chain
+from celery.signals import worker_init, worker_process_shutdown
+from ai_service import get_smart_proposal, aget_smart_proposal
+from async_runtime import get_runtime
 from web_generator import generate_page
-from pdf_generator import generate_pdf
-from database import update_proposal_with_data
+from pdf_generator import render_pdf_bytes
+from blob_store import get_blob_store
+from telegram_client import get_telegram_client, TelegramError
+from progress_reporter import ProgressReporter
+from media_preprocess import preprocess_media
+from database import init_db, close_connection, update_proposal_with_data, record_stage_timing, record_generation_result
+from catalog_engine import engine
+import price_cache
+import generation_cache
+from counter_buffer import counter_buffer
+import recalc
 
 redis_url = os.getenv("REDIS_URL")
 if not redis_url:
@@ -12,62 +27,277 @@ if not redis_url:
 
 celery_app = Celery('tasks', broker=redis_url, backend=redis_url)
 
+# Ожидание публикации на GitHub Pages: опрос с экспоненциальной паузой 1, 2, 4 ... 15 с
+PAGE_READY_MAX_POLLS = int(os.getenv("PAGE_READY_MAX_POLLS", "15"))
+PAGE_READY_MAX_BACKOFF = 15
+
+# Если задан PAGES_BASE_URL, страницы отдает наш FastAPI (/p/{id}) — они готовы сразу после записи в БД.
+# GitHub Pages тогда становится опциональным зеркалом (GITHUB_MIRROR=1), иначе остается основным хостингом.
+PAGES_BASE_URL = os.getenv("PAGES_BASE_URL")
+GITHUB_MIRROR = os.getenv("GITHUB_MIRROR", "0" if PAGES_BASE_URL else "1") == "1"
+
+# Async-режим: воркер запускается с пулом потоков (-P threads -c 50), а генерация КП
+# выполняется на общем event loop процесса. Потоки задач лишь ждут свои корутины,
+# поэтому один процесс ведет десятки генераций, упирающихся в Gemini/DuckDuckGo/Telegram.
+ASYNC_WORKER_MODE = os.getenv("ASYNC_WORKER_MODE", "0") == "1"
+
+# Публикация страниц идет в отдельную очередь, которую обслуживает один процесс
+# с пулом потоков: так одновременные публикации склеиваются в один коммит gh-pages.
+celery_app.conf.task_routes = {
+    "celery_worker.task_publish_page": {"queue": "publish"},
+}
+
+# Периодический прогрев кэша рыночных цен и очистка устаревших генераций (воркер запускается с -B)
+celery_app.conf.beat_schedule = {
+    "prewarm-market-prices": {
+        "task": "celery_worker.task_prewarm_prices",
+        "schedule": max(price_cache.PRICE_TTL // 2, 60),
+    },
+    "purge-generation-cache": {
+        "task": "celery_worker.task_purge_generation_cache",
+        "schedule": 3600,
+    },
+}
+
+@worker_init.connect
+def migrate_db(**kwargs):
+    """Миграции схемы в главном процессе воркера, до fork дочерних процессов."""
+    init_db()
+    # Соединение родителя не должно наследоваться дочерними процессами prefork
+    close_connection()
+
+@worker_process_shutdown.connect
+def flush_counters(**kwargs):
+    """Дочерний процесс prefork завершается без atexit — сбрасываем счетчики кэшей явно."""
+    counter_buffer.stop()
+
+def _record_timing(proposal_id: int, stage: str, duration_ms: float):
+    """Запись тайминга не должна ронять этап конвейера."""
+    try:
+        record_stage_timing(proposal_id, stage, duration_ms)
+    except Exception as e:
+        print(f"⚠️ [Worker] Не удалось записать тайминг этапа {stage}: {e}")
+
+@contextmanager
+def stage_timer(proposal_id: int, stage: str):
+    """Замеряет длительность этапа конвейера и пишет ее в stage_timings."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        print(f"⏱️ [Worker] КП #{proposal_id}: этап {stage} занял {duration_ms:.0f} мс")
+        _record_timing(proposal_id, stage, duration_ms)
+
+@celery_app.task
+def task_prewarm_prices():
+    models = [b["model"] for b in engine.index("boiler").items]
+    return price_cache.prewarm(models)
+
+@celery_app.task
+def task_purge_generation_cache():
+    return generation_cache.purge_expired()
+
+@celery_app.task
+def task_publish_page(proposal_id: int, client: str, task: str, proposal_data: dict):
+    """
+    Этап конвейера: рендер HTML и загрузка на GitHub Pages.
+    Исключения не выпускаем: упавший этап chord'а отменил бы доставку ссылки и PDF.
+    """
+    try:
+        with stage_timer(proposal_id, "page"):
+            return generate_page(proposal_id, client, task, proposal_data)
+    except Exception as e:
+        print(f"❌ [Worker] Публикация страницы КП #{proposal_id} упала: {e}")
+        return None
+
+@celery_app.task(bind=True, max_retries=PAGE_READY_MAX_POLLS)
+def task_wait_page_ready(self, build_id: str | None, proposal_id: int, web_url: str, poll_started_at: float = None):
+    """
+    Этап конвейера: ждет, пока GitHub Pages начнет отдавать именно эту сборку страницы.
+    Вместо sleep воркер переставляет задачу через retry, не занимая слот на время ожидания.
+    Возвращает True — страница доступна, False — загружена, но еще не появилась,
+    None — загрузка не удалась и по ссылке страницы не будет.
+    """
+    if not build_id:
+        return None  # Загрузка не удалась — ждать нечего
+    poll_started_at = poll_started_at or time.time()
+    try:
+        # Параметр v обходит CDN-кэш со старой версией страницы (актуально для пересчетов)
+        response = requests.get(web_url, params={"v": build_id}, timeout=5)
+        if response.status_code == 200 and build_id in response.text:
+            print(f"🌐 [Worker] Страница КП #{proposal_id} опубликована (попытка {self.request.retries + 1})")
+            _record_timing(proposal_id, "page_ready", (time.time() - poll_started_at) * 1000)
+            return True
+    except requests.exceptions.RequestException as e:
+        print(f"⚠️ [Worker] Проверка страницы КП #{proposal_id} не удалась: {e}")
+
+    if self.request.retries >= PAGE_READY_MAX_POLLS:
+        print(f"⚠️ [Worker] Страница КП #{proposal_id} так и не появилась, отправляем ссылку как есть")
+        _record_timing(proposal_id, "page_ready", (time.time() - poll_started_at) * 1000)
+        return False
+    raise self.retry(
+        kwargs={**(self.request.kwargs or {}), "poll_started_at": poll_started_at},
+        countdown=min(2 ** self.request.retries, PAGE_READY_MAX_BACKOFF)
+    )
+
+@celery_app.task
+def task_render_pdf(proposal_data: dict, proposal_id: int) -> str | None:
+    """
+    Этап конвейера: рендер PDF (выполняется параллельно с публикацией страницы).
+    PDF рендерится в память и кладется в общее хранилище, откуда его заберет доставка
+    на любом узле. Возвращает ключ в хранилище или None при ошибке рендера или хранилища —
+    тогда доставка все равно отправит ссылку.
+    """
+    try:
+        with stage_timer(proposal_id, "pdf"):
+            pdf_bytes = render_pdf_bytes(proposal_data, str(proposal_id))
+        if pdf_bytes is None:
+            return None
+        key = f"pdf:{proposal_id}:{uuid.uuid4().hex}"
+        get_blob_store().put(key, pdf_bytes)
+        return key
+    except Exception as e:
+        print(f"❌ [Worker] PDF КП #{proposal_id} не удалось подготовить: {e}")
+        return None
+
 @celery_app.task
-def task_send_result(chat_id: int, proposal_id: int, web_url: str, pdf_filename: str):
-    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+def task_send_result(stage_results: list, chat_id: int, proposal_id: int, web_url: str, started_at: float = None):
+    """
+    Финальный этап (callback chord'а): срабатывает, как только готовы и страница, и PDF.
+    stage_results: [ключ PDF в хранилище, статус страницы из task_wait_page_ready];
+    второго элемента нет, если страницу отдает наш сервер.
+    """
+    pdf_key = stage_results[0]
+    page_ready = stage_results[1] if len(stage_results) > 1 else True
+    with stage_timer(proposal_id, "deliver"):
+        _send_result(chat_id, proposal_id, web_url, pdf_key, page_ready)
+    if started_at:
+        _record_timing(proposal_id, "total", (time.time() - started_at) * 1000)
+    return True
+
+def _send_result(chat_id: int, proposal_id: int, web_url: str, pdf_key: str | None, page_ready: bool | None = True):
+    """page_ready: True — страница доступна, False — еще публикуется, None — публикация не удалась."""
+    telegram = get_telegram_client()
     
     # 🟢 ЖЕЛЕЗОБЕТОННЫЙ ФОРМАТ: обычное сложение строк
     part1 = "✅ Готово! Проект #" + str(proposal_id) + "\n\n"
     part2 = "🌐 Инженерная схема и смета: " + str(web_url) + "\n"
+    if page_ready is None:
+        part2 += ("⚠️ Страницу не удалось опубликовать — ссылка пока не откроется. "
+                  "Повторите публикацию командой /regenerate " + str(proposal_id) + ".\n")
+    elif not page_ready:
+        part2 += "⏳ Страница еще публикуется и появится по ссылке через пару минут.\n"
     part3 = "📄 Строгий PDF для печати прикреплен ниже 👇"
     msg_text = part1 + part2 + part3
     
     # 1. Отправляем текст и ссылку
-    requests.post("https://api.telegram.org/bot" + str(bot_token) + "/sendMessage", json={
-        "chat_id": chat_id,
-        "text": msg_text,
-        "parse_mode": "HTML"
-    })
+    try:
+        telegram.send_message(chat_id, msg_text, parse_mode="HTML")
+    except TelegramError as e:
+        print(f"❌ [Worker] Не удалось отправить ссылку на КП #{proposal_id}: {e}")
     
-    # 2. Отправляем PDF
-    if os.path.exists(pdf_filename):
-        with open(pdf_filename, "rb") as f:
-            requests.post("https://api.telegram.org/bot" + str(bot_token) + "/sendDocument", data={
-                "chat_id": chat_id
-            }, files={"document": f})
+    # 2. Отправляем PDF прямо из памяти, без промежуточного файла
+    pdf_bytes = get_blob_store().get(pdf_key) if pdf_key else None
+    if pdf_bytes:
+        try:
+            telegram.send_document(chat_id, pdf_bytes, f"proposal_{proposal_id}.pdf")
+        except TelegramError as e:
+            print(f"❌ [Worker] Не удалось отправить PDF КП #{proposal_id}: {e}")
         
-        # 3. Удаляем PDF после отправки
-        os.remove(pdf_filename) 
-    return True
+        # 3. Удаляем PDF из хранилища после отправки (иначе истечет по TTL)
+        get_blob_store().delete(pdf_key)
 
 @celery_app.task
-def task_generate_proposal(proposal_id: int, client: str, task: str, chat_id: int, media_path: str = None, media_type: str = "text"):
+def task_generate_proposal(proposal_id: int, client: str, task: str, chat_id: int, media_key: str = None, media_type: str = "text", bypass_cache: bool = False, progress_message_id: int = None, spec_seq: int = None):
     print(f"🔄 [Worker] Начинаю генерацию для КП #{proposal_id} (Type: {media_type})")
+    started_at = time.time()
+
+    # Если бот передал id сообщения "Принято в работу", показываем в нем разделы КП по мере генерации
+    progress = ProgressReporter(chat_id, progress_message_id, proposal_id) if progress_message_id else None
     
-    proposal_data = get_smart_proposal(task, media_path, media_type)
+    # Фото и голос ужимаем до вызова модели: меньше загрузка и входных токенов
+    if media_key and media_type in ("photo", "voice"):
+        with stage_timer(proposal_id, "preprocess"):
+            media_key = preprocess_media(media_key, media_type)
+
+    on_progress = progress.on_field if progress else None
+    # Event, а не флаг: в async-режиме колбэк вызывается в потоке общего event loop
+    cache_hit = threading.Event()
+    generate_started = time.perf_counter()
+    with stage_timer(proposal_id, "generate"):
+        if ASYNC_WORKER_MODE:
+            proposal_data = get_runtime().run(aget_smart_proposal(task, media_key, media_type, use_cache=not bypass_cache,
+                                                                  on_progress=on_progress, on_cache_hit=cache_hit.set))
+        else:
+            proposal_data = get_smart_proposal(task, media_key, media_type, use_cache=not bypass_cache,
+                                               on_progress=on_progress, on_cache_hit=cache_hit.set)
+
+    try:
+        record_generation_result(proposal_id, bool(proposal_data), (time.perf_counter() - generate_started) * 1000,
+                                 cached=cache_hit.is_set())
+    except Exception as e:
+        print(f"⚠️ [Worker] Не удалось обновить счетчики статистики: {e}")
     
-    if media_path and os.path.exists(media_path):
-        try:
-            os.remove(media_path)
-            print(f"🧹 [Worker] Временный файл {media_path} удален.")
-        except Exception as e:
-            print(f"⚠️ [Worker] Не удалось удалить {media_path}: {e}")
-            
+    # Пока шел пересчет, клиент прислал новую правку: этот результат устарел, его не сохраняем и не доставляем
+    if proposal_data and spec_seq is not None and not recalc.is_current(proposal_id, spec_seq):
+        print(f"⏭️ [Worker] Пересчет #{spec_seq} КП #{proposal_id} устарел, результат отброшен")
+        return False
+
+    # Медиа не удаляем: оно адресовано хэшем содержимого и истекает по MEDIA_TTL,
+    # а повторная генерация с тем же фото/голосом возьмет его и ссылку Gemini из кэша
     if proposal_data:
-        update_proposal_with_data(proposal_id, proposal_data)
-        generate_page(proposal_id, client, task, proposal_data)
+        # Для пересчета ТЗ и его номер записываются в КП; более старый номер запись не перезапишет
+        version = update_proposal_with_data(proposal_id, proposal_data,
+                                            task=task if spec_seq is not None else None, spec_seq=spec_seq)
+        if version is None:
+            print(f"⏭️ [Worker] В КП #{proposal_id} уже записан более новый пересчет, результат #{spec_seq} отброшен")
+            return False
+        if progress:
+            progress.sections.update(proposal_data)
+            progress.finish("✅ КП готово, публикую страницу и PDF...")
         
-        pdf_filename = f"proposal_{proposal_id}.pdf"
-        generate_pdf(proposal_data, pdf_filename, str(proposal_id))
-        
-        github_owner = os.getenv("GITHUB_OWNER", "coolmag")
-        github_repo = os.getenv("GITHUB_REPO", "KPbot")
-        web_url = f"https://{github_owner}.github.io/{github_repo}/proposals/{proposal_id}.html"
+        stages = [task_render_pdf.s(proposal_data, proposal_id)]
+
+        if PAGES_BASE_URL:
+            # Страница уже доступна на нашем сервере, GitHub — только зеркало, ждать его не нужно
+            web_url = f"{PAGES_BASE_URL.rstrip('/')}/p/{proposal_id}"
+            if GITHUB_MIRROR:
+                task_publish_page.delay(proposal_id, client, task, proposal_data)
+        else:
+            github_owner = os.getenv("GITHUB_OWNER", "coolmag")
+            github_repo = os.getenv("GITHUB_REPO", "KPbot")
+            web_url = f"https://{github_owner}.github.io/{github_repo}/proposals/{proposal_id}.html"
+            stages.append(chain(
+                task_publish_page.s(proposal_id, client, task, proposal_data),
+                task_wait_page_ready.s(proposal_id, web_url),
+            ))
         
-        task_send_result.apply_async(args=[chat_id, proposal_id, web_url, pdf_filename], countdown=10)
+        # Страница и PDF не зависят друг от друга: запускаем их параллельно,
+        # а доставка срабатывает сразу, как только PDF готов, а страница реально доступна по ссылке.
+        chord(stages)(task_send_result.s(chat_id, proposal_id, web_url, started_at))
         
-        print(f"✅ [Worker] КП #{proposal_id} сгенерировано. Отправка клиенту через 10 секунд...")
+        print(f"✅ [Worker] КП #{proposal_id} (версия {version}) сгенерировано. Публикация страницы и PDF запущены параллельно...")
         return True
         
     print(f"❌ [Worker] Ошибка AI-генерации для КП #{proposal_id}")
+    if progress:
+        progress.finish("❌ Не удалось сгенерировать КП. Попробуйте еще раз.")
     return False
+
+@celery_app.task
+def task_recalculate_proposal(proposal_id: int, seq: int):
+    """
+    Пересчет КП по правке клиента со страницы. Задача ставится с задержкой RECALC_DEBOUNCE:
+    если за это время пришла новая правка, ее номер больше и эта задача ничего не делает —
+    серия правок дает одну генерацию по последнему ТЗ.
+    """
+    if not recalc.is_current(proposal_id, seq):
+        print(f"⏭️ [Worker] Пересчет #{seq} КП #{proposal_id} заменен более новым, пропускаю")
+        return False
+    spec = recalc.load_spec(proposal_id, seq)
+    if spec is None:
+        print(f"❌ [Worker] ТЗ пересчета #{seq} КП #{proposal_id} не найдено (истек TTL?)")
+        return False
+    print(f"🔄 [Worker] Пересчет #{seq} КП #{proposal_id}")
+    return task_generate_proposal(proposal_id, spec["client"], spec["task"], spec["chat_id"], spec_seq=seq)
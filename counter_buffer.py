@@ -0,0 +1,83 @@
+import os
+import time
+import atexit
+import logging
+import threading
+
+from database import increment_cache_counters, touch_cached_generations
+
+logger = logging.getLogger(__name__)
+
+# Как часто накопленные счетчики и время доступа к кэшу генераций сбрасываются в SQLite
+FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", "10"))
+
+
+class CounterBuffer:
+    """
+    Счетчики попаданий/промахов кэшей в памяти процесса.
+    Чтение кэша ничего не пишет в БД: дельты и время последнего доступа к генерациям
+    копятся здесь и раз в FLUSH_INTERVAL уходят в SQLite одной транзакцией.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._counters: dict[tuple[str, str], int] = {}
+        self._touched: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # Поток не переживает fork (prefork-воркеры Celery) — запускаем его в каждом процессе заново
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="counter-buffer", daemon=True)
+        self._thread.start()
+
+    def increment(self, cache: str, counter: str, delta: int = 1):
+        with self._lock:
+            self._ensure_started()
+            key = (cache, counter)
+            self._counters[key] = self._counters.get(key, 0) + delta
+
+    def touch_generation(self, key: str):
+        """Запоминает доступ к записи кэша генераций для LRU-вытеснения."""
+        with self._lock:
+            self._ensure_started()
+            self._touched[key] = time.time()
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            touched, self._touched = self._touched, {}
+        if not counters and not touched:
+            return
+        try:
+            if counters:
+                increment_cache_counters([(cache, counter, delta) for (cache, counter), delta in counters.items()])
+            if touched:
+                touch_cached_generations(touched)
+        except Exception as e:
+            logger.error(f"❌ Не удалось сбросить счетчики кэшей: {e}")
+            # Возвращаем дельты в буфер: попробуем на следующем цикле
+            with self._lock:
+                for key, delta in counters.items():
+                    self._counters[key] = self._counters.get(key, 0) + delta
+                for key, ts in touched.items():
+                    self._touched[key] = max(ts, self._touched.get(key, 0))
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        """Останавливает поток и записывает все накопленное."""
+        self._stop.set()
+        self.flush()
+
+
+counter_buffer = CounterBuffer()
+atexit.register(counter_buffer.flush)
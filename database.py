@@ -3,6 +3,14 @@ import datetime
 from pathlib import Path
 import json
 import os
+import time
+import random
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
 
 # Если мы на Railway (есть переменная RAILWAY_ENVIRONMENT), используем папку /data
 # Иначе (на локальном ПК) создаем файл прямо в папке проекта
@@ -14,10 +22,90 @@ else:
 # 🛠️ ИСПРАВЛЕНИЕ: Принудительно создаем папку (например, /data), если её еще нет
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+# --- МЕНЕДЖЕР СОЕДИНЕНИЙ ---
+# Бот, Celery-воркеры и uvicorn работают с одним файлом. WAL позволяет читателям
+# (/ai, /history) не ждать, пока воркер пишет, а писателям — не ждать читателей.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",      # в WAL-режиме безопасно и сильно дешевле FULL
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",       # ~16 МБ страничного кэша на соединение
+)
+STATEMENT_CACHE_SIZE = 256
+BUSY_MAX_RETRIES = int(os.getenv("SQLITE_BUSY_RETRIES", "5"))
+BUSY_BACKOFF = 0.05
+
+_local = threading.local()
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Возвращает соединение текущего потока. Соединения кэшируются на поток и
+    привязаны к PID, поэтому после fork (Celery prefork) ребенок откроет свое.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    conn = sqlite3.connect(DB_PATH, timeout=5, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+def close_connection():
+    """Закрывает соединение текущего потока (при остановке процесса)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+def _is_busy_error(e: sqlite3.OperationalError) -> bool:
+    msg = str(e).lower()
+    return "locked" in msg or "busy" in msg
+
+def with_retry(func):
+    """Повторяет операцию при SQLITE_BUSY/LOCKED с ограниченным числом попыток и экспоненциальной паузой."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(BUSY_MAX_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not _is_busy_error(e) or attempt == BUSY_MAX_RETRIES - 1:
+                    raise
+                delay = BUSY_BACKOFF * (2 ** attempt) * (1 + random.random())
+                logger.warning(f"⏳ SQLite занята ({func.__name__}), повтор через {delay:.2f}s: {e}")
+                time.sleep(delay)
+    return wrapper
+
+@contextmanager
+def transaction():
+    """Курсор в рамках транзакции: commit при успехе, rollback при исключении."""
+    conn = get_connection()
     cursor = conn.cursor()
-    
+    try:
+        yield cursor
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция применяется один раз,
+# все недостающие — в одной транзакции BEGIN IMMEDIATE: бот, воркер и API стартуют
+# одновременно, и схему обновит первый, а остальные увидят уже новую версию.
+# Миграции 1-2 идемпотентны: БД, созданные до раннера (user_version = 0), проходят их без потерь.
+
+def _ensure_column(cursor, table: str, column: str, decl: str):
+    """ALTER TABLE ADD COLUMN для уже существующих БД, если колонки еще нет."""
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _migration_base_schema(cursor):
     # Обновленная таблица предложений с версионированием
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS proposals (
@@ -30,6 +118,8 @@ def init_db():
         version INTEGER DEFAULT 1
     )
     """)
+    # Время последнего изменения proposal_data (Last-Modified для /p/{id})
+    _ensure_column(cursor, "proposals", "updated_at", "TEXT")
     
     # НОВАЯ ТАБЛИЦА: Система событий (Events)
     cursor.execute("""
@@ -42,90 +132,558 @@ def init_db():
         FOREIGN KEY(proposal_id) REFERENCES proposals(id)
     )
     """)
-    conn.commit()
-    conn.close()
 
-def log_event(proposal_id: str, event_type: str, metadata: dict = None):
-    """Функция для записи любого действия клиента"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    # Кэш рыночных цен (DuckDuckGo) по модели оборудования
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS price_cache (
+        model TEXT PRIMARY KEY,
+        context TEXT,
+        fetched_at REAL  -- unix time, для проверки TTL
+    )
+    """)
+
+    # Кэш полных AI-генераций КП по хэшу входных данных
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS generation_cache (
+        key TEXT PRIMARY KEY,
+        data TEXT,          -- распарсенный JSON КП
+        created_at REAL,
+        last_access REAL    -- для LRU-вытеснения
+    )
+    """)
+
+    # Длительность этапов конвейера генерации (generate, page, pdf, deliver, total)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS stage_timings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        proposal_id INTEGER,
+        stage TEXT,
+        duration_ms REAL,
+        created_at TEXT
+    )
+    """)
+
+    # Счетчики попаданий/промахов кэшей, общие для всех процессов
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS cache_counters (
+        cache TEXT,
+        counter TEXT,
+        value INTEGER DEFAULT 0,
+        PRIMARY KEY (cache, counter)
+    )
+    """)
+
+def _migration_analytics_rollups(cursor):
+    # Роллапы событий по КП: обновляются в той же транзакции, что и вставка событий
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS proposal_analytics (
+        proposal_id INTEGER PRIMARY KEY,
+        opens INTEGER DEFAULT 0,
+        max_scroll_depth INTEGER DEFAULT 0,   -- в процентах
+        plans_view_seconds INTEGER DEFAULT 0,
+        plan_clicks INTEGER DEFAULT 0,
+        pay_clicks INTEGER DEFAULT 0,
+        ai_questions INTEGER DEFAULT 0,
+        recalculations INTEGER DEFAULT 0,
+        first_seen TEXT,
+        last_seen TEXT
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS proposal_plan_clicks (
+        proposal_id INTEGER,
+        plan_name TEXT,
+        clicks INTEGER DEFAULT 0,
+        pay_clicks INTEGER DEFAULT 0,
+        PRIMARY KEY (proposal_id, plan_name)
+    )
+    """)
+
+    # БД, созданные до роллапов: один раз собираем их из накопленных событий
+    if cursor.execute("SELECT 1 FROM proposal_analytics LIMIT 1").fetchone() is None:
+        rows = cursor.execute(f"SELECT {_EVENT_COLUMNS} FROM events ORDER BY id").fetchall()
+        if rows:
+            _apply_rollups(cursor, rows)
+            logger.info(f"📈 Роллапы аналитики собраны из {len(rows)} событий")
+
+def _migration_indexes(cursor):
+    # История менеджера: WHERE user_id ORDER BY id DESC LIMIT 10 — покрывающий индекс, без обращения к таблице
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_proposals_user_id ON proposals (user_id, id, client, created_at)")
+    # События одного КП по времени (аналитика, разбор сессий)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_proposal_ts ON events (proposal_id, timestamp)")
+    # Тайминги этапов одного КП
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stage_timings_proposal ON stage_timings (proposal_id, id)")
+    # LRU-вытеснение кэша генераций идет по last_access
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_generation_cache_access ON generation_cache (last_access)")
+
+def _migration_proposal_stats(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS proposal_stats (
+        scope TEXT,                 -- 'total' | 'user' | 'day'
+        key TEXT,                   -- '' | user_id | YYYY-MM-DD
+        created INTEGER DEFAULT 0,
+        succeeded INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        generation_ms_total REAL DEFAULT 0,
+        generation_count INTEGER DEFAULT 0,
+        PRIMARY KEY (scope, key)
+    )
+    """)
+    # Бэкфилл из накопленных КП: неудачи раньше не записывались, время — из stage_timings
+    cursor.execute("DELETE FROM proposal_stats")
+    timings = """
+    LEFT JOIN (SELECT proposal_id, SUM(duration_ms) AS ms, COUNT(*) AS n
+               FROM stage_timings WHERE stage = 'generate' GROUP BY proposal_id) t ON t.proposal_id = p.id
+    """
+    aggregates = "COUNT(*), COUNT(p.proposal_data), COALESCE(SUM(t.ms), 0), COALESCE(SUM(t.n), 0)"
+    for scope, key_expr in (("total", "''"), ("user", "CAST(p.user_id AS TEXT)"), ("day", "substr(p.created_at, 1, 10)")):
+        cursor.execute(f"""
+        INSERT INTO proposal_stats (scope, key, created, succeeded, generation_ms_total, generation_count)
+        SELECT '{scope}', {key_expr}, {aggregates}
+        FROM proposals p {timings}
+        GROUP BY {key_expr}
+        """)
+
+def _migration_proposal_versions(cursor):
+    # Номер ТЗ пересчета, по которому построены текущие данные: результат более старого номера не записывается
+    _ensure_column(cursor, "proposals", "spec_seq", "INTEGER DEFAULT 0")
+    # История версий КП: каждая запись proposal_data сохраняется вместе с ТЗ, по которому ее построили
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS proposal_versions (
+        proposal_id INTEGER,
+        version INTEGER,
+        task TEXT,
+        proposal_data TEXT,
+        spec_seq INTEGER DEFAULT 0,
+        created_at TEXT,
+        PRIMARY KEY (proposal_id, version)
+    )
+    """)
+    # Уже сгенерированные КП: текущие данные становятся их последней версией
     cursor.execute("""
-    INSERT INTO events (proposal_id, event_type, timestamp, metadata)
-    VALUES (?, ?, ?, ?)
-    """, (
-        proposal_id, 
-        event_type, 
-        datetime.datetime.now().isoformat(), 
+    INSERT OR IGNORE INTO proposal_versions (proposal_id, version, task, proposal_data, created_at)
+    SELECT id, version, task, proposal_data, COALESCE(updated_at, created_at)
+    FROM proposals WHERE proposal_data IS NOT NULL
+    """)
+
+def _migration_stats_cache_hits(cursor):
+    # Исторические строки не различали кэш и генерацию — для них cache_hits остается 0
+    _ensure_column(cursor, "proposal_stats", "cache_hits", "INTEGER DEFAULT 0")
+
+MIGRATIONS = [
+    (1, "базовая схема: КП, события, кэши, тайминги", _migration_base_schema),
+    (2, "роллапы аналитики по КП", _migration_analytics_rollups),
+    (3, "индексы proposals/events/stage_timings/generation_cache", _migration_indexes),
+    (4, "счетчики статистики по пользователям и дням", _migration_proposal_stats),
+    (5, "история версий КП и номер ТЗ пересчета", _migration_proposal_versions),
+    (6, "ответы из кэша генераций в статистике отдельно", _migration_stats_cache_hits),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version() -> int:
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+@with_retry
+def migrate() -> int:
+    """Применяет недостающие миграции и возвращает версию схемы."""
+    current = get_schema_version()
+    if current >= SCHEMA_VERSION:
+        if current > SCHEMA_VERSION:
+            logger.warning(f"⚠️ Схема БД v{current} новее кода (v{SCHEMA_VERSION}) — миграции пропущены")
+        return current
+
+    conn = get_connection()
+    # IMMEDIATE сразу берет блокировку записи: параллельный старт другого процесса
+    # подождет (busy_timeout) и затем увидит уже обновленную версию
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.cursor()
+        current = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for version, description, apply in MIGRATIONS:
+            if version <= current:
+                continue
+            started = time.perf_counter()
+            apply(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            logger.info(f"🧱 Миграция БД v{version} ({description}) за {(time.perf_counter() - started) * 1000:.0f} мс")
+            current = version
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return current
+
+def init_db():
+    """Готовит БД к работе: вызывается при старте бота, воркера и API."""
+    migrate()
+
+_EVENT_COLUMNS = "proposal_id, event_type, timestamp, metadata"
+_INSERT_EVENT_SQL = f"""
+INSERT INTO events ({_EVENT_COLUMNS})
+VALUES (?, ?, ?, ?)
+"""
+
+# --- РОЛЛАПЫ АНАЛИТИКИ ---
+_ANALYTICS_FIELDS = (
+    "opens", "max_scroll_depth", "plans_view_seconds", "plan_clicks",
+    "pay_clicks", "ai_questions", "recalculations", "first_seen", "last_seen"
+)
+# Счетчики суммируются, глубина скролла — максимум, первое/последнее появление — min/max
+_UPSERT_ANALYTICS_SQL = """
+INSERT INTO proposal_analytics (proposal_id, opens, max_scroll_depth, plans_view_seconds, plan_clicks,
+                                pay_clicks, ai_questions, recalculations, first_seen, last_seen)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(proposal_id) DO UPDATE SET
+    opens = opens + excluded.opens,
+    max_scroll_depth = MAX(max_scroll_depth, excluded.max_scroll_depth),
+    plans_view_seconds = plans_view_seconds + excluded.plans_view_seconds,
+    plan_clicks = plan_clicks + excluded.plan_clicks,
+    pay_clicks = pay_clicks + excluded.pay_clicks,
+    ai_questions = ai_questions + excluded.ai_questions,
+    recalculations = recalculations + excluded.recalculations,
+    first_seen = MIN(first_seen, excluded.first_seen),
+    last_seen = MAX(last_seen, excluded.last_seen)
+"""
+_UPSERT_PLAN_CLICKS_SQL = """
+INSERT INTO proposal_plan_clicks (proposal_id, plan_name, clicks, pay_clicks)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(proposal_id, plan_name) DO UPDATE SET
+    clicks = clicks + excluded.clicks,
+    pay_clicks = pay_clicks + excluded.pay_clicks
+"""
+ANALYTICS_SQL = f"SELECT {', '.join(_ANALYTICS_FIELDS)} FROM proposal_analytics WHERE proposal_id = ?"
+PLAN_CLICKS_SQL = """
+SELECT plan_name, clicks, pay_clicks FROM proposal_plan_clicks
+WHERE proposal_id = ? ORDER BY clicks + pay_clicks DESC
+"""
+# Страница шлет viewing_plans_long после 10 с на тарифах, дальше plans_view_time каждые 30 с
+_DEFAULT_VIEW_SECONDS = {"viewing_plans_long": 10, "plans_view_time": 30}
+
+def _aggregate_events(rows: list[tuple]) -> tuple[dict, dict]:
+    """Сворачивает пачку строк events в дельты роллапов по КП и по тарифам."""
+    analytics, plans = {}, {}
+    for proposal_id, event_type, timestamp, metadata in rows:
+        try:
+            pid = int(proposal_id)
+        except (TypeError, ValueError):
+            continue  # мусорный proposal_id из /track — в роллапы не берем
+        meta = json.loads(metadata) if metadata else {}
+        a = analytics.get(pid)
+        if a is None:
+            a = analytics[pid] = dict.fromkeys(_ANALYTICS_FIELDS, 0)
+            a["first_seen"] = a["last_seen"] = timestamp
+        a["first_seen"] = min(a["first_seen"], timestamp)
+        a["last_seen"] = max(a["last_seen"], timestamp)
+
+        if event_type == "opened":
+            a["opens"] += 1
+        elif event_type.startswith("scrolled"):
+            depth = meta.get("depth") or event_type.rpartition("_")[2]
+            try:
+                a["max_scroll_depth"] = max(a["max_scroll_depth"], int(depth))
+            except (TypeError, ValueError):
+                pass
+        elif event_type in _DEFAULT_VIEW_SECONDS:
+            try:
+                a["plans_view_seconds"] += int(meta.get("seconds", _DEFAULT_VIEW_SECONDS[event_type]))
+            except (TypeError, ValueError):
+                pass
+        elif event_type in ("plan_clicked", "pay_advance_clicked"):
+            pay = event_type == "pay_advance_clicked"
+            a["pay_clicks" if pay else "plan_clicks"] += 1
+            key = (pid, str(meta.get("plan_name") or "—"))
+            clicks = plans.setdefault(key, [0, 0])
+            clicks[1 if pay else 0] += 1
+        elif event_type == "ai_question":
+            a["ai_questions"] += 1
+        elif event_type == "recalculation_triggered":
+            a["recalculations"] += 1
+    return analytics, plans
+
+def _apply_rollups(cursor, rows: list[tuple]):
+    analytics, plans = _aggregate_events(rows)
+    if analytics:
+        cursor.executemany(_UPSERT_ANALYTICS_SQL, [
+            (pid, *(a[field] for field in _ANALYTICS_FIELDS)) for pid, a in analytics.items()
+        ])
+    if plans:
+        cursor.executemany(_UPSERT_PLAN_CLICKS_SQL, [
+            (pid, name, clicks, pay_clicks) for (pid, name), (clicks, pay_clicks) in plans.items()
+        ])
+
+def analytics_from_rows(row: tuple | None, plan_rows: list[tuple]) -> dict | None:
+    """Строки роллапов -> ответ для API и бота (общий для sync и async слоя)."""
+    if row is None:
+        return None
+    result = dict(zip(_ANALYTICS_FIELDS, row))
+    result["plans"] = [
+        {"plan_name": name, "clicks": clicks, "pay_clicks": pay_clicks}
+        for name, clicks, pay_clicks in plan_rows
+    ]
+    return result
+
+def make_event_row(proposal_id: str, event_type: str, metadata: dict = None) -> tuple:
+    """Готовит кортеж для вставки в таблицу events (фиксирует время события в момент вызова)."""
+    return (
+        proposal_id,
+        event_type,
+        datetime.datetime.now().isoformat(),
         json.dumps(metadata) if metadata else "{}"
-    ))
-    conn.commit()
-    conn.close()
+    )
+
+def log_event(proposal_id: str, event_type: str, metadata: dict = None):
+    """Функция для записи любого действия клиента"""
+    log_events_batch([make_event_row(proposal_id, event_type, metadata)])
+
+@with_retry
+def log_events_batch(rows: list[tuple]):
+    """Пакетная запись событий и обновление роллапов аналитики одной транзакцией."""
+    if not rows:
+        return
+    with transaction() as cursor:
+        cursor.executemany(_INSERT_EVENT_SQL, rows)
+        _apply_rollups(cursor, rows)
 
+# --- СЧЕТЧИКИ СТАТИСТИКИ ---
+# Итоги ведутся при записи (в той же транзакции) в трех разрезах: всего, по менеджеру, по дню.
+# /stats читает их по первичному ключу и не зависит от размера proposals.
+# Ответы из кэша генераций (~0 мс) считаются в cache_hits, а не в среднем времени генерации.
+_STATS_FIELDS = ("created", "succeeded", "failed", "generation_ms_total", "generation_count", "cache_hits")
+_UPSERT_STATS_SQL = """
+INSERT INTO proposal_stats (scope, key, created, succeeded, failed, generation_ms_total, generation_count, cache_hits)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(scope, key) DO UPDATE SET
+    created = created + excluded.created,
+    succeeded = succeeded + excluded.succeeded,
+    failed = failed + excluded.failed,
+    generation_ms_total = generation_ms_total + excluded.generation_ms_total,
+    generation_count = generation_count + excluded.generation_count,
+    cache_hits = cache_hits + excluded.cache_hits
+"""
+
+def _bump_stats(cursor, user_id, day: str, **deltas):
+    values = tuple(deltas.get(field, 0) for field in _STATS_FIELDS)
+    keys = [("total", ""), ("day", day)]
+    if user_id is not None:
+        keys.append(("user", str(user_id)))
+    cursor.executemany(_UPSERT_STATS_SQL, [(scope, key, *values) for scope, key in keys])
+
+@with_retry
 def save_proposal(user_id, client, task):
     """Сохраняет первоначальную информацию о лиде и возвращает ID."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-    INSERT INTO proposals (user_id, client, task, created_at, proposal_data)
-    VALUES (?, ?, ?, ?, ?)
-    """, (
-        user_id,
-        client,
-        task,
-        datetime.datetime.now().isoformat(),
-        None  # proposal_data is initially empty
-    ))
-    proposal_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return proposal_id
-
-def update_proposal_with_data(proposal_id, proposal_data):
-    """Обновляет запись в БД, добавляя полный JSON сгенерированного КП."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-    UPDATE proposals
-    SET proposal_data = ?
-    WHERE id = ?
-    """, (
-        json.dumps(proposal_data, ensure_ascii=False),
-        proposal_id
-    ))
-    conn.commit()
-    conn.close()
+    now = datetime.datetime.now()
+    with transaction() as cursor:
+        cursor.execute("""
+        INSERT INTO proposals (user_id, client, task, created_at, proposal_data)
+        VALUES (?, ?, ?, ?, ?)
+        """, (
+            user_id,
+            client,
+            task,
+            now.isoformat(),
+            None  # proposal_data is initially empty
+        ))
+        _bump_stats(cursor, user_id, now.date().isoformat(), created=1)
+        return cursor.lastrowid
 
+@with_retry
+def record_generation_result(proposal_id, ok: bool, duration_ms: float, cached: bool = False):
+    """
+    Итог одной генерации (первой или пересчета) в счетчики статистики.
+    cached — КП отдано из кэша генераций: считается успехом, но не входит в среднее время генерации.
+    """
+    if cached:
+        deltas = {"succeeded": 1, "cache_hits": 1}
+    else:
+        deltas = {"succeeded": int(ok), "failed": int(not ok), "generation_ms_total": duration_ms, "generation_count": 1}
+    with transaction() as cursor:
+        row = cursor.execute("SELECT user_id FROM proposals WHERE id = ?", (proposal_id,)).fetchone()
+        _bump_stats(cursor, row[0] if row else None, datetime.date.today().isoformat(), **deltas)
 
+@with_retry
+def update_proposal_with_data(proposal_id, proposal_data, task=None, spec_seq=None):
+    """
+    Обновляет запись в БД, добавляя полный JSON сгенерированного КП, и сохраняет его в proposal_versions.
+    Первая генерация остается версией 1, каждый пересчет увеличивает version.
+    Для пересчета передаются новое ТЗ и его номер spec_seq: если в БД уже лежит результат
+    более нового ТЗ, запись не меняется. Возвращает номер записанной версии или None.
+    """
+    now = datetime.datetime.now().isoformat()
+    with transaction() as cursor:
+        cursor.execute("""
+        UPDATE proposals
+        SET proposal_data = ?,
+            version = CASE WHEN proposal_data IS NULL THEN version ELSE version + 1 END,
+            updated_at = ?,
+            task = COALESCE(?, task),
+            spec_seq = COALESCE(?, spec_seq)
+        WHERE id = ? AND (? IS NULL OR COALESCE(spec_seq, 0) < ?)
+        """, (
+            json.dumps(proposal_data, ensure_ascii=False),
+            now,
+            task,
+            spec_seq,
+            proposal_id,
+            spec_seq,
+            spec_seq
+        ))
+        if cursor.rowcount == 0:
+            return None
+        version, task, data, seq = cursor.execute(
+            "SELECT version, task, proposal_data, spec_seq FROM proposals WHERE id = ?", (proposal_id,)
+        ).fetchone()
+        cursor.execute("""
+        INSERT OR REPLACE INTO proposal_versions (proposal_id, version, task, proposal_data, spec_seq, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """, (proposal_id, version, task, data, seq or 0, now))
+        return version
+
+@with_retry
 def get_user_history(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    cursor = get_connection().execute("""
     SELECT id, client, created_at
     FROM proposals
     WHERE user_id = ?
     ORDER BY id DESC
     LIMIT 10
     """, (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    return cursor.fetchall()
 
 
-def get_stats():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM proposals")
-    total = cursor.fetchone()[0]
-    conn.close()
-    return total
+def _stats_row(values) -> dict:
+    result = dict(zip(_STATS_FIELDS, values or (0,) * len(_STATS_FIELDS)))
+    count = result.pop("generation_count")
+    total_ms = result.pop("generation_ms_total")
+    result["avg_generation_ms"] = round(total_ms / count) if count else None
+    return result
+
+@with_retry
+def get_stats(user_id=None, days: int = 7) -> dict:
+    """
+    Сводка для /stats из счетчиков: всего, сегодня, последние `days` дней по дням
+    и (если передан user_id) по менеджеру. Только чтения по первичному ключу.
+    """
+    conn = get_connection()
+    sql = f"SELECT {', '.join(_STATS_FIELDS)} FROM proposal_stats WHERE scope = ? AND key = ?"
+    today = datetime.date.today()
+    recent = [(today - datetime.timedelta(days=i)).isoformat() for i in range(days)]
+    result = {
+        "total": _stats_row(conn.execute(sql, ("total", "")).fetchone()),
+        "days": {day: _stats_row(conn.execute(sql, ("day", day)).fetchone()) for day in recent},
+    }
+    result["today"] = result["days"][recent[0]]
+    if user_id is not None:
+        result["user"] = _stats_row(conn.execute(sql, ("user", str(user_id))).fetchone())
+    return result
+
+@with_retry
+def get_proposal_source(proposal_id) -> tuple[int, str, str] | None:
+    """(user_id, client, task) КП — для повторной генерации по команде менеджера."""
+    row = get_connection().execute("SELECT user_id, client, task FROM proposals WHERE id = ?", (proposal_id,)).fetchone()
+    return (row[0], row[1], row[2]) if row else None
 
+@with_retry
 def get_proposal_data(proposal_id: str) -> dict | None:
     """Извлекает полный JSON предложения по его ID."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT proposal_data FROM proposals WHERE id = ?", (proposal_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = get_connection().execute("SELECT proposal_data FROM proposals WHERE id = ?", (proposal_id,)).fetchone()
     if row and row[0]:
         return json.loads(row[0])
     return None
+
+@with_retry
+def get_cached_price(model: str) -> tuple[str, float] | None:
+    """Возвращает (контекст цен, время получения) или None."""
+    row = get_connection().execute("SELECT context, fetched_at FROM price_cache WHERE model = ?", (model,)).fetchone()
+    return (row[0], row[1]) if row else None
+
+@with_retry
+def save_cached_price(model: str, context: str, fetched_at: float):
+    with transaction() as cursor:
+        cursor.execute("""
+        INSERT INTO price_cache (model, context, fetched_at) VALUES (?, ?, ?)
+        ON CONFLICT(model) DO UPDATE SET context = excluded.context, fetched_at = excluded.fetched_at
+        """, (model, context, fetched_at))
+
+@with_retry
+def increment_cache_counters(rows: list[tuple[str, str, int]]):
+    """Прибавляет пачку дельт (cache, counter, delta) одной транзакцией — сброс из counter_buffer."""
+    with transaction() as cursor:
+        cursor.executemany("""
+        INSERT INTO cache_counters (cache, counter, value) VALUES (?, ?, ?)
+        ON CONFLICT(cache, counter) DO UPDATE SET value = value + excluded.value
+        """, rows)
+
+@with_retry
+def get_cache_counters(cache: str | None = None) -> dict:
+    """{cache: {counter: value}} по всем кэшам или по одному."""
+    sql = "SELECT cache, counter, value FROM cache_counters"
+    params = ()
+    if cache:
+        sql += " WHERE cache = ?"
+        params = (cache,)
+    result = {}
+    for name, counter, value in get_connection().execute(sql, params).fetchall():
+        result.setdefault(name, {})[counter] = value
+    return result
+
+@with_retry
+def get_proposal_analytics(proposal_id) -> dict | None:
+    """Вовлеченность клиента по КП из роллапов — два чтения по первичному ключу."""
+    conn = get_connection()
+    row = conn.execute(ANALYTICS_SQL, (proposal_id,)).fetchone()
+    plan_rows = conn.execute(PLAN_CLICKS_SQL, (proposal_id,)).fetchall() if row else []
+    return analytics_from_rows(row, plan_rows)
+
+@with_retry
+def get_cached_generation(key: str, ttl: float) -> dict | None:
+    """Возвращает закэшированный JSON генерации, если он моложе ttl. Только чтение: время доступа копит counter_buffer."""
+    row = get_connection().execute(
+        "SELECT data FROM generation_cache WHERE key = ? AND created_at >= ?", (key, time.time() - ttl)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+@with_retry
+def touch_cached_generations(last_access: dict[str, float]):
+    """Обновляет last_access пачкой {key: время доступа} для LRU-вытеснения."""
+    with transaction() as cursor:
+        cursor.executemany(
+            "UPDATE generation_cache SET last_access = MAX(last_access, ?) WHERE key = ?",
+            [(ts, key) for key, ts in last_access.items()]
+        )
+
+@with_retry
+def purge_expired_generations(ttl: float) -> int:
+    """Удаляет генерации старше ttl (периодическая задача, а не каждое чтение). Возвращает число удаленных."""
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM generation_cache WHERE created_at < ?", (time.time() - ttl,))
+        return cursor.rowcount
+
+@with_retry
+def save_cached_generation(key: str, data: dict, max_entries: int):
+    """Сохраняет генерацию и вытесняет самые давно использованные записи сверх max_entries."""
+    now = time.time()
+    with transaction() as cursor:
+        cursor.execute("""
+        INSERT INTO generation_cache (key, data, created_at, last_access) VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET data = excluded.data, created_at = excluded.created_at, last_access = excluded.last_access
+        """, (key, json.dumps(data, ensure_ascii=False), now, now))
+        cursor.execute("""
+        DELETE FROM generation_cache WHERE key IN (
+            SELECT key FROM generation_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+        )
+        """, (max_entries,))
+
+@with_retry
+def record_stage_timing(proposal_id, stage: str, duration_ms: float):
+    with transaction() as cursor:
+        cursor.execute("""
+        INSERT INTO stage_timings (proposal_id, stage, duration_ms, created_at) VALUES (?, ?, ?, ?)
+        """, (proposal_id, stage, duration_ms, datetime.datetime.now().isoformat()))
+
+@with_retry
+def get_stage_timings(proposal_id) -> dict:
+    """{этап: длительность в мс} для одного КП (последний замер каждого этапа)."""
+    rows = get_connection().execute("""
+    SELECT stage, duration_ms FROM stage_timings WHERE proposal_id = ? ORDER BY id
+    """, (proposal_id,)).fetchall()
+    return dict(rows)
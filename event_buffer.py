@@ -0,0 +1,135 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+from database import make_event_row, log_events_batch
+
+logger = logging.getLogger(__name__)
+
+# Пороги сброса буфера: по количеству событий или по времени (что наступит раньше)
+FLUSH_SIZE = int(os.getenv("EVENT_FLUSH_SIZE", "200"))
+FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", "1.0"))
+# Жесткий предел очереди, чтобы при зависшей БД не съесть всю память
+MAX_QUEUE = int(os.getenv("EVENT_QUEUE_MAX", "10000"))
+
+
+class EventBuffer:
+    """
+    Write-behind буфер телеметрии.
+    /track кладет событие в очередь и сразу отвечает клиенту, а фоновый поток
+    пишет накопленные события в таблицу events пачками через executemany.
+    """
+
+    def __init__(self, flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL, max_queue: int = MAX_QUEUE):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Метрики
+        self.flushed_total = 0
+        self.dropped_total = 0
+        self.flush_count = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.last_batch_size = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="event-buffer", daemon=True)
+        self._thread.start()
+        logger.info(f"🗃️ Буфер событий запущен (batch={self.flush_size}, interval={self.flush_interval}s)")
+
+    def push(self, proposal_id: str, event_type: str, metadata: dict = None) -> bool:
+        """Неблокирующая постановка события в очередь. Возвращает False, если очередь переполнена."""
+        try:
+            self._queue.put_nowait(make_event_row(proposal_id, event_type, metadata))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped_total += 1
+            logger.warning(f"⚠️ Очередь событий переполнена, событие {event_type} для КП #{proposal_id} отброшено")
+            return False
+
+    def _collect_batch(self) -> list[tuple]:
+        """Ждет первое событие, затем добирает пачку до flush_size или до истечения flush_interval."""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self) -> list[tuple]:
+        batch = []
+        while len(batch) < self.flush_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch: list[tuple]):
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            log_events_batch(batch)
+        except Exception as e:
+            logger.error(f"❌ Не удалось записать пачку из {len(batch)} событий: {e}")
+            with self._lock:
+                self.dropped_total += len(batch)
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.flushed_total += len(batch)
+            self.flush_count += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.last_batch_size = len(batch)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._flush(self._collect_batch())
+        # Дренируем все, что успело накопиться до остановки
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            self._flush(batch)
+
+    def stop(self, timeout: float = 10.0):
+        """Останавливает поток и дожидается записи всех оставшихся событий."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            if self._thread.is_alive():
+                logger.error(f"❌ Буфер событий не успел сброситься за {timeout}s, в очереди {self._queue.qsize()}")
+            self._thread = None
+        logger.info(f"🗃️ Буфер событий остановлен. Записано всего: {self.flushed_total}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "flushed_total": self.flushed_total,
+                "dropped_total": self.dropped_total,
+                "flush_count": self.flush_count,
+                "last_batch_size": self.last_batch_size,
+                "last_flush_ms": round(self.last_flush_ms, 2),
+                "max_flush_ms": round(self.max_flush_ms, 2),
+            }
+
+
+event_buffer = EventBuffer()
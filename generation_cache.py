@@ -0,0 +1,56 @@
+import os
+import json
+import hashlib
+import logging
+
+from database import get_cached_generation, save_cached_generation, purge_expired_generations, get_cache_counters
+from counter_buffer import counter_buffer
+
+logger = logging.getLogger(__name__)
+
+# Генерация КП детерминирована входом (ТЗ + котел + цены + модель), поэтому
+# повторный запрос с тем же входом можно отдать из кэша за миллисекунды.
+GENERATION_TTL = int(os.getenv("GENERATION_CACHE_TTL", str(7 * 24 * 3600)))
+GENERATION_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX", "500"))
+CACHE_NAME = "generation"
+
+
+def _normalize_prompt(prompt: str | None) -> str:
+    # Лишние пробелы и переводы строк не должны давать новый ключ
+    return " ".join((prompt or "").split())
+
+
+def make_key(prompt: str | None, boiler_model: str, price_context: str, model_name: str, media_digest: str | None = None) -> str:
+    """Контентный адрес генерации: sha256 от нормализованного входа."""
+    payload = json.dumps({
+        "prompt": _normalize_prompt(prompt),
+        "boiler": boiler_model,
+        "prices": price_context,
+        "model": model_name,
+        "media": media_digest,
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get(key: str) -> dict | None:
+    data = get_cached_generation(key, GENERATION_TTL)
+    counter_buffer.increment(CACHE_NAME, "hit" if data is not None else "miss")
+    if data is not None:
+        counter_buffer.touch_generation(key)
+        logger.info(f"⚡ Генерация найдена в кэше ({key[:12]})")
+    return data
+
+
+def put(key: str, data: dict):
+    save_cached_generation(key, data, GENERATION_MAX_ENTRIES)
+
+
+def purge_expired() -> int:
+    removed = purge_expired_generations(GENERATION_TTL)
+    if removed:
+        logger.info(f"🧹 Из кэша генераций удалено устаревших записей: {removed}")
+    return removed
+
+
+def stats() -> dict:
+    return get_cache_counters(CACHE_NAME).get(CACHE_NAME, {})
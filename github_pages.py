@@ -1,7 +1,12 @@
 import base64
 import requests
 import os
+import time
+import random
 import logging
+import threading
+import subprocess
+from concurrent.futures import Future
 
 logger = logging.getLogger(__name__)
 
@@ -9,60 +14,252 @@ logger = logging.getLogger(__name__)
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 OWNER = os.getenv("GITHUB_OWNER", "coolmag")
 REPO = os.getenv("GITHUB_REPO", "KPbot")
+BRANCH = "gh-pages"
 
+# Путь к локальному bare-репозиторию вместо GitHub (для тестов и локальной отладки)
+LOCAL_REPO = os.getenv("GITHUB_PAGES_LOCAL_REPO")
 
-def upload_page(filename: str, content: str):
+# Страницы, пришедшие в течение окна, уходят одним коммитом
+BATCH_WINDOW = float(os.getenv("GITHUB_BATCH_WINDOW", "1.5"))
+MAX_BATCH_SIZE = 50
+MAX_CONFLICT_RETRIES = 5
+UPLOAD_TIMEOUT = 120
+
+COMMITTER = {"name": "KPbot AI", "email": "bot@kp-generator.ai"}
+
+
+class GitHubBackend:
+    """Git Data API: blobs -> tree -> commit -> ref update."""
+
+    def __init__(self, token: str, owner: str, repo: str, branch: str = BRANCH):
+        self.base_url = f"https://api.github.com/repos/{owner}/{repo}/git"
+        self.branch = branch
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/vnd.github.v3+json"
+        })
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        return self.session.request(method, f"{self.base_url}/{path}", timeout=30, **kwargs)
+
+    def get_head(self) -> str | None:
+        response = self._request("GET", f"ref/heads/{self.branch}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()["object"]["sha"]
+
+    def get_commit_tree(self, commit_sha: str) -> str:
+        response = self._request("GET", f"commits/{commit_sha}")
+        response.raise_for_status()
+        return response.json()["tree"]["sha"]
+
+    def create_blob(self, content: bytes) -> str:
+        response = self._request("POST", "blobs", json={
+            "content": base64.b64encode(content).decode("utf-8"),
+            "encoding": "base64"
+        })
+        response.raise_for_status()
+        return response.json()["sha"]
+
+    def create_tree(self, base_tree: str | None, entries: dict[str, str]) -> str:
+        data = {"tree": [{"path": path, "mode": "100644", "type": "blob", "sha": sha} for path, sha in entries.items()]}
+        if base_tree:
+            data["base_tree"] = base_tree
+        response = self._request("POST", "trees", json=data)
+        response.raise_for_status()
+        return response.json()["sha"]
+
+    def create_commit(self, message: str, tree: str, parent: str | None) -> str:
+        response = self._request("POST", "commits", json={
+            "message": message,
+            "tree": tree,
+            "parents": [parent] if parent else [],
+            "author": COMMITTER,
+            "committer": COMMITTER
+        })
+        response.raise_for_status()
+        return response.json()["sha"]
+
+    def update_ref(self, new_sha: str, old_sha: str | None) -> bool:
+        """Fast-forward ветки. False — если ветку успел сдвинуть другой воркер."""
+        if old_sha is None:
+            response = self._request("POST", "refs", json={"ref": f"refs/heads/{self.branch}", "sha": new_sha})
+        else:
+            response = self._request("PATCH", f"refs/heads/{self.branch}", json={"sha": new_sha, "force": False})
+        if response.status_code == 422:
+            return False
+        response.raise_for_status()
+        return True
+
+
+class LocalGitBackend:
+    """Тот же протокол поверх локального bare-репозитория (git plumbing), без сети."""
+
+    def __init__(self, repo_path: str, branch: str = BRANCH):
+        self.repo_path = repo_path
+        self.branch = branch
+        if not os.path.exists(repo_path):
+            subprocess.run(["git", "init", "--bare", "-q", repo_path], check=True)
+
+    def _git(self, *args, input: bytes = None, env: dict = None) -> subprocess.CompletedProcess:
+        full_env = {**os.environ, **(env or {})}
+        return subprocess.run(["git", "--git-dir", self.repo_path, *args], input=input, env=full_env, capture_output=True)
+
+    def _git_out(self, *args, **kwargs) -> str:
+        result = self._git(*args, **kwargs)
+        if result.returncode != 0:
+            raise RuntimeError(f"git {' '.join(args)}: {result.stderr.decode().strip()}")
+        return result.stdout.decode().strip()
+
+    def get_head(self) -> str | None:
+        result = self._git("rev-parse", "--verify", "-q", f"refs/heads/{self.branch}")
+        return result.stdout.decode().strip() if result.returncode == 0 else None
+
+    def get_commit_tree(self, commit_sha: str) -> str:
+        return self._git_out("rev-parse", f"{commit_sha}^{{tree}}")
+
+    def create_blob(self, content: bytes) -> str:
+        return self._git_out("hash-object", "-w", "--stdin", input=content)
+
+    def create_tree(self, base_tree: str | None, entries: dict[str, str]) -> str:
+        index_path = os.path.join(self.repo_path, f"kpbot-index-{os.getpid()}-{threading.get_ident()}")
+        env = {"GIT_INDEX_FILE": index_path}
+        try:
+            if base_tree:
+                self._git_out("read-tree", base_tree, env=env)
+            else:
+                self._git_out("read-tree", "--empty", env=env)
+            for path, sha in entries.items():
+                self._git_out("update-index", "--add", "--cacheinfo", f"100644,{sha},{path}", env=env)
+            return self._git_out("write-tree", env=env)
+        finally:
+            if os.path.exists(index_path):
+                os.remove(index_path)
+
+    def create_commit(self, message: str, tree: str, parent: str | None) -> str:
+        args = ["commit-tree", tree, "-m", message]
+        if parent:
+            args += ["-p", parent]
+        env = {
+            "GIT_AUTHOR_NAME": COMMITTER["name"], "GIT_AUTHOR_EMAIL": COMMITTER["email"],
+            "GIT_COMMITTER_NAME": COMMITTER["name"], "GIT_COMMITTER_EMAIL": COMMITTER["email"],
+        }
+        return self._git_out(*args, env=env)
+
+    def update_ref(self, new_sha: str, old_sha: str | None) -> bool:
+        # update-ref со старым значением — атомарный compare-and-swap
+        result = self._git("update-ref", f"refs/heads/{self.branch}", new_sha, old_sha or "0" * 40)
+        return result.returncode == 0
+
+
+class BatchPublisher:
     """
-    Загружает сгенерированную HTML страницу в репозиторий GitHub через API.
-    Это создает или перезаписывает файл.
+    Копит страницы в течение BATCH_WINDOW и публикует их одним коммитом.
+    При конфликте (ветку сдвинул другой процесс) пересобирает дерево на новой
+    вершине и повторяет, переиспользуя уже созданные blob'ы.
     """
-    if not GITHUB_TOKEN:
-        logger.error("GITHUB_TOKEN не найден! Не могу загрузить страницу на GitHub.")
-        return
 
-    path = f"proposals/{filename}"
-    url = f"https://api.github.com/repos/{OWNER}/{REPO}/contents/{path}"
-
-    # Кодируем контент в Base64
-    encoded_content = base64.b64encode(content.encode('utf-8')).decode('utf-8')
-
-    # Данные для коммита
-    data = {
-        "message": f"feat: Add/update proposal {filename}",
-        "content": encoded_content,
-        "committer": {
-            "name": "KPbot AI",
-            "email": "bot@kp-generator.ai"
-        }
-    }
-    
-    # Заголовки для аутентификации
-    headers = {
-        "Authorization": f"Bearer {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
+    def __init__(self, backend, window: float = BATCH_WINDOW, max_batch: int = MAX_BATCH_SIZE):
+        self.backend = backend
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: list[tuple[str, bytes, Future]] = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="gh-pages-publisher", daemon=True)
+        self._thread.start()
 
-    try:
-        # Проверяем, существует ли файл в ветке gh-pages, чтобы получить SHA для обновления
-        get_response = requests.get(url, headers=headers, params={"ref": "gh-pages"})
-        if get_response.status_code == 200:
-            data['sha'] = get_response.json()['sha']
-            logger.info(f"Файл {path} существует в ветке gh-pages. Обновляю его.")
-        else:
-            logger.info(f"Файл {path} не найден в ветке gh-pages. Создаю новый.")
+    def submit(self, path: str, content: str) -> Future:
+        future = Future()
+        with self._cond:
+            self._pending.append((path, content.encode("utf-8"), future))
+            self._cond.notify()
+        return future
+
+    def _take_batch(self) -> list[tuple[str, bytes, Future]]:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                ok = self._commit(batch)
+            except Exception as e:
+                logger.error(f"Ошибка при публикации пачки страниц на GitHub: {e}")
+                ok = False
+            for _, _, future in batch:
+                future.set_result(ok)
 
-        # Указываем ветку gh-pages для коммита
-        data['branch'] = 'gh-pages'
+    def _commit(self, batch: list[tuple[str, bytes, Future]]) -> bool:
+        # Если одну страницу обновили дважды за окно, в коммит идет последняя версия
+        files = {path: content for path, content, _ in batch}
+        blobs = {path: self.backend.create_blob(content) for path, content in files.items()}
+        names = ", ".join(os.path.basename(path) for path in files)
+        message = f"feat: Add/update proposals {names}" if len(files) > 1 else f"feat: Add/update proposal {names}"
 
-        # Отправляем запрос на создание/обновление файла
-        response = requests.put(url, json=data, headers=headers)
-        response.raise_for_status()  # Вызовет исключение для статусов 4xx/5xx
-        
-        logger.info(f"✅ Успешно загружен файл {filename} в ветку 'gh-pages' репозитория {OWNER}/{REPO}.")
-        logger.debug(f"Ответ GitHub API: {response.json()}")
+        for attempt in range(MAX_CONFLICT_RETRIES):
+            head = self.backend.get_head()
+            base_tree = self.backend.get_commit_tree(head) if head else None
+            tree = self.backend.create_tree(base_tree, blobs)
+            commit = self.backend.create_commit(message, tree, head)
+            if self.backend.update_ref(commit, head):
+                logger.info(f"✅ Опубликовано {len(files)} стр. одним коммитом {commit[:7]} в ветку '{BRANCH}' репозитория {OWNER}/{REPO}.")
+                return True
+            delay = 0.2 * (2 ** attempt) * (1 + random.random())
+            logger.warning(f"⚠️ Ветка {BRANCH} сдвинулась во время публикации, повтор через {delay:.2f}s")
+            time.sleep(delay)
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при загрузке файла в GitHub: {e}")
-        if e.response is not None:
-            logger.error(f"Тело ответа: {e.response.text}")
+        logger.error(f"❌ Не удалось опубликовать {len(files)} стр.: ветка постоянно сдвигается")
+        return False
 
+
+_publisher: BatchPublisher | None = None
+_publisher_pid: int | None = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher() -> BatchPublisher | None:
+    """Публикатор текущего процесса (создается лениво, после fork — заново)."""
+    global _publisher, _publisher_pid
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            if LOCAL_REPO:
+                backend = LocalGitBackend(LOCAL_REPO)
+            elif GITHUB_TOKEN:
+                backend = GitHubBackend(GITHUB_TOKEN, OWNER, REPO)
+            else:
+                return None
+            _publisher = BatchPublisher(backend)
+            _publisher_pid = os.getpid()
+        return _publisher
+
+
+def upload_page(filename: str, content: str) -> bool:
+    """
+    Публикует сгенерированную HTML страницу в ветку gh-pages.
+    Страницы, пришедшие почти одновременно, попадают в один коммит.
+    Возвращает True при успешном коммите.
+    """
+    publisher = get_publisher()
+    if publisher is None:
+        logger.error("GITHUB_TOKEN не найден! Не могу загрузить страницу на GitHub.")
+        return False
+
+    path = f"proposals/{filename}"
+    try:
+        return publisher.submit(path, content).result(timeout=UPLOAD_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке файла {path} в GitHub: {e}")
+        return False
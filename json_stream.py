@@ -0,0 +1,116 @@
+import json
+
+
+class IncrementalJSONObject:
+    """
+    Инкрементальный разбор JSON-объекта, который модель отдает кусками (streaming).
+    Следит только за полями верхнего уровня: как только значение поля закрыто,
+    оно парсится и попадает в fields. Маркдаун-обертка (```json) перед '{' пропускается.
+    Каждый символ просматривается один раз, поэтому стоимость линейна по длине ответа.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields: dict = {}
+        self.done = False
+        self._pos = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+
+    def feed(self, chunk: str) -> list[str]:
+        """Добавляет кусок текста. Возвращает имена полей, завершившихся в этом куске."""
+        self.buffer += chunk
+        buf = self.buffer
+        completed = []
+        for i in range(self._pos, len(buf)):
+            if self.done:
+                break
+            ch = buf[i]
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        if self._key_start is not None:
+                            self._key = json.loads(buf[self._key_start:i + 1])
+                            self._key_start = None
+                        elif self._value_start is not None:
+                            self._complete(buf[self._value_start:i + 1], completed)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    if self._key is None:
+                        self._key_start = i
+                    elif self._value_start is None:
+                        self._value_start = i
+            elif ch in "{[":
+                if self._depth == 1 and self._key is not None and self._value_start is None:
+                    self._value_start = i
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._value_start is not None:
+                    self._complete(buf[self._value_start:i + 1], completed)
+                elif self._depth == 0:
+                    # Последнее поле-скаляр закрывается самим объектом
+                    if self._value_start is not None:
+                        self._complete(buf[self._value_start:i], completed)
+                    self.done = True
+            elif self._depth == 1:
+                if ch == ",":
+                    if self._value_start is not None:
+                        self._complete(buf[self._value_start:i], completed)
+                elif ch != ":" and not ch.isspace() and self._key is not None and self._value_start is None:
+                    self._value_start = i  # число, true/false/null
+        self._pos = len(buf)
+        return completed
+
+    def _complete(self, raw: str, completed: list[str]):
+        try:
+            self.fields[self._key] = json.loads(raw.strip())
+            completed.append(self._key)
+        except json.JSONDecodeError:
+            pass  # битое значение — пусть разбирается финальный json.loads
+        self._key = None
+        self._value_start = None
+
+    def partial_string(self, key: str) -> str | None:
+        """
+        Текущее (возможно, недописанное) значение строкового поля верхнего уровня.
+        Нужно, чтобы показывать ответ модели по мере генерации.
+        """
+        if key in self.fields:
+            value = self.fields[key]
+            return value if isinstance(value, str) else None
+        if self._key != key or self._value_start is None or not self._in_string:
+            return None
+        if self.buffer[self._value_start] != '"':
+            return None
+        raw = self.buffer[self._value_start + 1:]
+        # Отрезаем недописанную escape-последовательность в конце (\ или \uXX)
+        cut = raw.rfind("\\")
+        if cut != -1 and cut >= len(raw) - 6:
+            tail = raw[cut:]
+            backslashes = len(raw[:cut + 1]) - len(raw[:cut + 1].rstrip("\\"))
+            if backslashes % 2 == 1 and (len(tail) == 1 or (tail[1] == "u" and len(tail) < 6)):
+                raw = raw[:cut]
+        try:
+            return json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            return None
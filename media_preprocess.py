@@ -0,0 +1,85 @@
+import io
+import os
+import shutil
+import logging
+import subprocess
+
+from PIL import Image, ImageOps
+
+import media_store
+from counter_buffer import counter_buffer
+
+logger = logging.getLogger(__name__)
+
+# Фото с телефона (4000px, 3-5 МБ) модели не нужны целиком: длинная сторона
+# MEDIA_MAX_SIDE и JPEG качества MEDIA_JPEG_QUALITY дают тот же смысл за доли трафика и токенов.
+MEDIA_MAX_SIDE = int(os.getenv("MEDIA_MAX_SIDE", "1536"))
+MEDIA_JPEG_QUALITY = int(os.getenv("MEDIA_JPEG_QUALITY", "82"))
+# Голосовые: моно 16 кГц Opus, тишина по краям срезается, длина ограничена
+MEDIA_MAX_VOICE_SECONDS = int(os.getenv("MEDIA_MAX_VOICE_SECONDS", "300"))
+FFMPEG_TIMEOUT = 60
+STATS_NAME = "media_preprocess"
+
+FFMPEG = shutil.which("ffmpeg")
+_SILENCE = "silenceremove=start_periods=1:start_threshold=-50dB:start_silence=0.3"
+VOICE_FILTER = f"{_SILENCE},areverse,{_SILENCE},areverse,loudnorm"
+
+
+def preprocess_image(data: bytes) -> bytes:
+    """Поворот по EXIF, уменьшение до MEDIA_MAX_SIDE и пережатие в JPEG без метаданных."""
+    with Image.open(io.BytesIO(data)) as img:
+        # Сначала применяем ориентацию: после удаления EXIF повернуть будет не по чему
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((MEDIA_MAX_SIDE, MEDIA_MAX_SIDE), Image.LANCZOS)
+        out = io.BytesIO()
+        # exif не передаем — GPS и данные телефона в Gemini не уходят
+        img.save(out, format="JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def preprocess_voice(data: bytes) -> bytes:
+    """Нормализация громкости и обрезка тишины через ffmpeg; без ffmpeg — как есть."""
+    if not FFMPEG:
+        return data
+    result = subprocess.run(
+        [FFMPEG, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+         "-t", str(MEDIA_MAX_VOICE_SECONDS), "-af", VOICE_FILTER,
+         "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-f", "ogg", "pipe:1"],
+        input=data, capture_output=True, timeout=FFMPEG_TIMEOUT, check=True
+    )
+    return result.stdout or data
+
+
+def preprocess_media(media_key: str, media_type: str) -> str:
+    """
+    Этап конвейера перед вызовом модели: возвращает ключ обработанного медиа
+    в media_store (или исходный ключ, если обработка не удалась / не дала выигрыша).
+    Размеры до и после копятся в cache_counters, чтобы видеть экономию.
+    """
+    data = media_store.get(media_key)
+    if data is None:
+        return media_key
+    try:
+        if media_type == "photo":
+            processed, suffix = preprocess_image(data), ".jpg"
+        elif media_type == "voice":
+            processed, suffix = preprocess_voice(data), ".ogg"
+        else:
+            return media_key
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось обработать медиа {media_key}, отправляем оригинал: {e}")
+        return media_key
+
+    # Пережатое фото без EXIF берем, даже если оно не меньше; голос — только если стал меньше
+    if media_type == "voice" and len(processed) >= len(data):
+        processed = data
+    counter_buffer.increment(STATS_NAME, f"{media_type}_items")
+    counter_buffer.increment(STATS_NAME, f"{media_type}_original_bytes", len(data))
+    counter_buffer.increment(STATS_NAME, f"{media_type}_processed_bytes", len(processed))
+    logger.info(f"🗜️ Медиа ({media_type}): {len(data) // 1024} КБ -> {len(processed) // 1024} КБ")
+
+    if processed is data:
+        return media_key
+    return media_store.put(processed, suffix)
@@ -0,0 +1,65 @@
+import os
+import json
+import hashlib
+import logging
+
+from blob_store import get_blob_store
+from database import get_cache_counters
+from counter_buffer import counter_buffer
+
+logger = logging.getLogger(__name__)
+
+# Фото и голосовые из бота лежат в общем хранилище артефактов (Redis или BLOB_STORE_DIR)
+# под адресом sha256 содержимого: воркер на любом узле читает их по ключу,
+# а одинаковые файлы хранятся и загружаются в Gemini один раз.
+MEDIA_TTL = int(os.getenv("MEDIA_TTL", str(2 * 24 * 3600)))
+# Gemini Files API хранит загруженные файлы 48 часов — держим ссылку чуть меньше
+GEMINI_FILE_TTL = int(os.getenv("GEMINI_FILE_TTL", str(47 * 3600)))
+CACHE_NAME = "gemini_files"
+
+MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".ogg": "audio/ogg",
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+}
+
+
+def put(data: bytes, suffix: str) -> str:
+    """Сохраняет медиа и возвращает ключ вида media:<sha256><suffix>. Повтор продлевает TTL."""
+    key = f"media:{hashlib.sha256(data).hexdigest()}{suffix}"
+    store = get_blob_store()
+    if not store.touch(key, MEDIA_TTL):
+        store.put(key, data, ttl=MEDIA_TTL)
+    return key
+
+
+def get(key: str) -> bytes | None:
+    return get_blob_store().get(key)
+
+
+def digest(key: str) -> str:
+    return os.path.splitext(key.split(":", 1)[1])[0]
+
+
+def mime_type(key: str) -> str:
+    return MIME_TYPES.get(os.path.splitext(key)[1].lower(), "application/octet-stream")
+
+
+def get_gemini_file(key: str) -> dict | None:
+    """Ранее загруженный в Gemini файл с тем же содержимым: {"uri", "mime_type"} или None."""
+    raw = get_blob_store().get(f"gemini_file:{digest(key)}")
+    counter_buffer.increment(CACHE_NAME, "hit" if raw else "miss")
+    return json.loads(raw) if raw else None
+
+
+def save_gemini_file(key: str, uri: str, mime: str):
+    payload = json.dumps({"uri": uri, "mime_type": mime}).encode("utf-8")
+    get_blob_store().put(f"gemini_file:{digest(key)}", payload, ttl=GEMINI_FILE_TTL)
+
+
+def stats() -> dict:
+    return get_cache_counters(CACHE_NAME).get(CACHE_NAME, {})
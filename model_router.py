@@ -0,0 +1,274 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних вызовов модели учитывать в статистике
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))
+# Меньше замеров — перцентилям не доверяем: такая модель сначала набирает замеры (идет первой)
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+# Доля вызовов, которые пробуют не лучшую здоровую модель: окно проигравшей модели
+# иначе не обновляется, и она не вернется на первое место, даже если стала быстрее
+ROUTER_EXPLORE_RATE = float(os.getenv("ROUTER_EXPLORE_RATE", "0.05"))
+# Модель нездорова, если доля ошибок в окне выше порога и последняя ошибка была недавно
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "60"))
+ROUTER_MAX_WORKERS = int(os.getenv("ROUTER_MAX_WORKERS", "16"))
+
+
+def hedge_delay_from_env(name: str, default: str = "") -> float | None:
+    """Минимальная задержка хеджа для места вызова: пустое значение или 'off' — хедж выключен."""
+    value = os.getenv(name, default).strip().lower()
+    return None if value in ("", "off") else float(value)
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class ModelStats:
+    """Скользящее окно по одной модели: латентности успешных вызовов и исходы."""
+
+    def __init__(self, window: int = ROUTER_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.last_failure = 0.0
+        self.wins = 0
+
+    def record(self, latency: float, ok: bool):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+        else:
+            self.last_failure = time.monotonic()
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def percentile(self, q: float) -> float | None:
+        if len(self.latencies) < ROUTER_MIN_SAMPLES:
+            return None
+        return _percentile(sorted(self.latencies), q)
+
+    @property
+    def healthy(self) -> bool:
+        return not (self.error_rate > ROUTER_MAX_ERROR_RATE
+                    and time.monotonic() - self.last_failure < ROUTER_COOLDOWN)
+
+
+class ModelRouter:
+    """
+    Маршрутизация запросов к LLM по наблюдаемой латентности.
+    Кандидаты упорядочиваются: сначала здоровые, среди них — еще не набравшие
+    ROUTER_MIN_SAMPLES замеров (в порядке вызывающего), затем по p50. Изредка
+    (ROUTER_EXPLORE_RATE) первой идет случайная другая здоровая модель — проба.
+    Если первая модель не ответила за свой p95 (но не раньше min_delay места вызова),
+    параллельно уходит хедж-запрос ко второй, и побеждает первый успешный ответ.
+    Пока у модели меньше ROUTER_MIN_SAMPLES замеров, хеджа нет: без p95 он лишь
+    удвоил бы платные вызовы. Ошибка (в т.ч. невалидный
+    ответ, на котором fn бросил исключение) передает ход следующей модели.
+    Статистика живет в процессе; sync-вариант для воркеров, async — для FastAPI.
+    """
+
+    def __init__(self, explore_rate: float = ROUTER_EXPLORE_RATE):
+        self.explore_rate = explore_rate
+        self._stats: dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+        self._executor_pid: int | None = None
+        self.hedged_total = 0
+        self.hedge_wins = 0
+        self.probes_total = 0
+
+    def _get(self, model: str) -> ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats.setdefault(model, ModelStats())
+        return stats
+
+    def record(self, model: str, latency: float, ok: bool):
+        with self._lock:
+            self._get(model).record(latency, ok)
+
+    def ranked(self, candidates: list[str]) -> list[str]:
+        """
+        Порядок попыток. Модели без статистики идут раньше измеренных (сохраняя порядок
+        вызывающего): иначе запасная модель при выключенном хедже никогда не была бы замерена.
+        """
+        with self._lock:
+            def key(model):
+                stats = self._get(model)
+                p50 = stats.percentile(0.5)
+                return (not stats.healthy, p50 is not None, p50 or 0.0)
+            order = sorted(dict.fromkeys(candidates), key=key)
+            if len(order) > 1 and random.random() < self.explore_rate:
+                others = [model for model in order[1:] if self._get(model).healthy]
+                if others:
+                    probe = random.choice(others)
+                    order.remove(probe)
+                    order.insert(0, probe)
+                    self.probes_total += 1
+            return order
+
+    def pick(self, candidates: list[str]) -> str:
+        return self.ranked(candidates)[0]
+
+    def hedge_delay(self, model: str, min_delay: float = 0.0) -> float | None:
+        """Через сколько секунд хеджировать вызов модели; None — замеров еще мало, не хеджируем."""
+        with self._lock:
+            p95 = self._get(model).percentile(0.95)
+        return max(p95, min_delay) if p95 is not None else None
+
+    def _mark_win(self, model: str, hedged: bool):
+        with self._lock:
+            self._get(model).wins += 1
+            if hedged:
+                self.hedge_wins += 1
+
+    def _mark_hedge(self, model: str, primary: str):
+        with self._lock:
+            self.hedged_total += 1
+        logger.info(f"🪁 {primary} дольше своего p95 — хеджируем запросом к {model}")
+
+    # --- sync ---
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # После fork Celery пул потоков родителя не наследуется — создаем свой
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=ROUTER_MAX_WORKERS, thread_name_prefix="model-router")
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _timed(self, model: str, fn):
+        started = time.perf_counter()
+        try:
+            result = fn(model)
+        except Exception:
+            self.record(model, time.perf_counter() - started, False)
+            raise
+        self.record(model, time.perf_counter() - started, True)
+        return result
+
+    def call(self, candidates: list[str], fn, hedge_delay: float | None = None):
+        """
+        fn(model) -> результат; исключение считается ошибкой модели.
+        hedge_delay — минимальная задержка хеджа для этого места вызова, None — без хеджа.
+        Проигравший хедж дорабатывает в фоне (поток не прервать) и оплачивается целиком,
+        поэтому для долгих генераций хедж выключают или ставят задержку побольше.
+        """
+        remaining = self.ranked(candidates)
+        pending = {}
+        last_error = None
+
+        def launch():
+            model = remaining.pop(0)
+            pending[self._pool().submit(self._timed, model, fn)] = model
+            return model
+
+        primary = launch()
+        while pending:
+            timeout = None
+            if hedge_delay is not None and remaining and len(pending) == 1:
+                timeout = self.hedge_delay(next(iter(pending.values())), hedge_delay)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                self._mark_hedge(launch(), primary)
+                continue
+            for future in done:
+                model = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    logger.warning(f"⚠️ Модель {model} не справилась: {e}")
+                    continue
+                self._mark_win(model, hedged=model != primary)
+                return result
+            if not pending and remaining:
+                primary = launch()
+        raise last_error or RuntimeError("Нет моделей-кандидатов")
+
+    # --- async ---
+
+    async def _atimed(self, model: str, fn):
+        started = time.perf_counter()
+        try:
+            result = await fn(model)
+        except asyncio.CancelledError:
+            raise  # отмененный проигравший хедж — не ошибка модели
+        except Exception:
+            self.record(model, time.perf_counter() - started, False)
+            raise
+        self.record(model, time.perf_counter() - started, True)
+        return result
+
+    async def acall(self, candidates: list[str], fn, hedge_delay: float | None = None):
+        """Асинхронный вариант call: fn(model) — корутина; проигравший хедж отменяется."""
+        remaining = self.ranked(candidates)
+        pending = {}
+        last_error = None
+
+        def launch():
+            model = remaining.pop(0)
+            pending[asyncio.ensure_future(self._atimed(model, fn))] = model
+            return model
+
+        primary = launch()
+        try:
+            while pending:
+                timeout = None
+                if hedge_delay is not None and remaining and len(pending) == 1:
+                    timeout = self.hedge_delay(next(iter(pending.values())), hedge_delay)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self._mark_hedge(launch(), primary)
+                    continue
+                for task in done:
+                    model = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        last_error = e
+                        logger.warning(f"⚠️ Модель {model} не справилась: {e}")
+                        continue
+                    self._mark_win(model, hedged=model != primary)
+                    return result
+                if not pending and remaining:
+                    primary = launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise last_error or RuntimeError("Нет моделей-кандидатов")
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = {}
+            for model, stats in self._stats.items():
+                p50, p95 = stats.percentile(0.5), stats.percentile(0.95)
+                models[model] = {
+                    "p50_ms": round(p50 * 1000) if p50 is not None else None,
+                    "p95_ms": round(p95 * 1000) if p95 is not None else None,
+                    "error_rate": round(stats.error_rate, 3),
+                    "samples": len(stats.outcomes),
+                    "healthy": stats.healthy,
+                    "wins": stats.wins,
+                }
+            return {
+                "models": models,
+                "hedged_total": self.hedged_total,
+                "hedge_wins": self.hedge_wins,
+                "probes_total": self.probes_total,
+            }
+
+
+router = ModelRouter()
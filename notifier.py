@@ -0,0 +1,155 @@
+import os
+import time
+import asyncio
+import logging
+
+import httpx
+
+from telegram_client import AsyncTelegramClient, TelegramError
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+MANAGER_ID = os.getenv("MANAGER_TELEGRAM_ID")
+
+# Окно, в течение которого события одного КП склеиваются в один дайджест
+COALESCE_WINDOW = float(os.getenv("NOTIFY_COALESCE_WINDOW", "5"))
+
+
+class NotificationDispatcher:
+    """
+    Диспетчер уведомлений менеджеру.
+    HTTP-обработчики только кладут текст в очередь (enqueue), а фоновая задача
+    дедуплицирует и склеивает события одного КП за окно COALESCE_WINDOW в одно
+    сообщение. Лимиты Telegram и retry_after на 429 соблюдает AsyncTelegramClient.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW):
+        self.window = window
+        # proposal_id -> {текст: сколько раз пришел}; dict сохраняет порядок событий
+        self._pending: dict[str, dict[str, int]] = {}
+        self._deadlines: dict[str, float] = {}
+        # Дайджесты, взятые из очереди, но еще не отправленные: при отмене возвращаются в _pending
+        self._inflight: dict[str, dict[str, int]] = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+        self._telegram: AsyncTelegramClient | None = None
+
+        self.enqueued_total = 0
+        self.coalesced_total = 0
+        self.sent_total = 0
+        self.failed_total = 0
+
+    def start(self, http_client: httpx.AsyncClient):
+        self._telegram = AsyncTelegramClient(http_client)
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, proposal_id: str, text: str, urgent: bool = False):
+        """Ставит уведомление в очередь, не дожидаясь Telegram. urgent — отправить без окна склейки."""
+        key = str(proposal_id)
+        lines = self._pending.setdefault(key, {})
+        if text in lines:
+            self.coalesced_total += 1
+        lines[text] = lines.get(text, 0) + 1
+        self.enqueued_total += 1
+
+        deadline = time.monotonic() + (0 if urgent else self.window)
+        self._deadlines[key] = min(self._deadlines.get(key, deadline), deadline)
+        self._wakeup.set()
+
+    @staticmethod
+    def _format_digest(proposal_id: str, lines: dict[str, int]) -> str:
+        rendered = [text if count == 1 else f"{text} (×{count})" for text, count in lines.items()]
+        if len(rendered) == 1:
+            return rendered[0]
+        return f"📌 Активность по КП `#{proposal_id}`:\n\n" + "\n\n".join(rendered)
+
+    def _take_due(self, force: bool = False) -> list[str]:
+        """Переносит созревшие КП из очереди в _inflight и возвращает их ключи."""
+        now = time.monotonic()
+        due = [key for key, deadline in self._deadlines.items() if force or deadline <= now]
+        for key in due:
+            del self._deadlines[key]
+            self._inflight[key] = self._pending.pop(key)
+        return due
+
+    def _restore_inflight(self):
+        """Возвращает неотправленные дайджесты в очередь (раньше новых строк того же КП)."""
+        for key, lines in self._inflight.items():
+            for text, count in self._pending.pop(key, {}).items():
+                lines[text] = lines.get(text, 0) + count
+            self._pending[key] = lines
+            self._deadlines[key] = time.monotonic()
+        self._inflight.clear()
+
+    async def _run(self):
+        try:
+            while True:
+                self._wakeup.clear()
+                for key in self._take_due(force=self._stopping):
+                    try:
+                        await self._send(self._format_digest(key, self._inflight[key]))
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        self.failed_total += 1
+                        logger.error(f"❌ Сбой диспетчера уведомлений: {e}")
+                    del self._inflight[key]
+                if self._stopping:
+                    if not self._pending:
+                        return
+                    continue
+                timeout = None
+                if self._deadlines:
+                    timeout = max(0.0, min(self._deadlines.values()) - time.monotonic())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            self._restore_inflight()
+            raise
+
+    async def _send(self, text: str):
+        if not BOT_TOKEN or not MANAGER_ID:
+            logger.error("TELEGRAM_BOT_TOKEN или MANAGER_TELEGRAM_ID не установлены!")
+            return
+        try:
+            await self._telegram.send_message(MANAGER_ID, text, parse_mode="Markdown")
+            self.sent_total += 1
+            logger.info(f"Уведомление успешно отправлено: {text}")
+        except TelegramError as e:
+            self.failed_total += 1
+            logger.error(f"Ошибка при отправке уведомления в Telegram: {e}")
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Просит фоновую задачу отправить все, что осталось в очереди, без окна склейки
+        и дожидается ее завершения. Не успели за timeout — неотправленное считается failed.
+        """
+        if not self._task:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            # По таймауту wait_for отменяет задачу, и она возвращает взятые дайджесты в очередь
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            self.failed_total += len(self._pending)
+            logger.error(f"❌ Не удалось отправить уведомления по {len(self._pending)} КП за {timeout}s: "
+                         f"{', '.join(self._pending)}")
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "pending_proposals": len(self._pending) + len(self._inflight),
+            "in_flight": len(self._inflight),
+            "enqueued_total": self.enqueued_total,
+            "coalesced_total": self.coalesced_total,
+            "sent_total": self.sent_total,
+            "failed_total": self.failed_total,
+        }
+
+
+dispatcher = NotificationDispatcher()
@@ -0,0 +1,83 @@
+import os
+import gzip
+import datetime
+import threading
+from email.utils import format_datetime
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # brotli опционален: без него отдаем gzip
+    brotli = None
+
+# Сколько отрендеренных страниц держать в памяти процесса
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "256"))
+
+
+def page_etag(proposal_id, version: int, template_rev: str) -> str:
+    """ETag зависит только от версии КП и ревизии шаблона — 304 можно отдать без рендера."""
+    return f'"p{proposal_id}-v{version}-{template_rev}"'
+
+
+def http_date(iso_timestamp: str | None) -> str | None:
+    if not iso_timestamp:
+        return None
+    dt = datetime.datetime.fromisoformat(iso_timestamp).astimezone(datetime.timezone.utc)
+    return format_datetime(dt, usegmt=True)
+
+
+class RenderedPage:
+    """Готовая страница: исходный HTML и заранее сжатые варианты тела."""
+
+    def __init__(self, html: str, etag: str, last_modified: str | None):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.identity = html.encode("utf-8")
+        self.gzip = gzip.compress(self.identity, compresslevel=6)
+        self.br = brotli.compress(self.identity, quality=5) if brotli else None
+
+    def body_for(self, accept_encoding: str) -> tuple[str | None, bytes]:
+        """(Content-Encoding, тело) с учетом Accept-Encoding клиента."""
+        accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+        if self.br is not None and "br" in accepted:
+            return "br", self.br
+        if "gzip" in accepted:
+            return "gzip", self.gzip
+        return None, self.identity
+
+
+class PageCache:
+    """Ограниченный LRU отрендеренных страниц. Новая версия КП вытесняет старую запись."""
+
+    def __init__(self, max_size: int = PAGE_CACHE_SIZE):
+        self.max_size = max_size
+        self._pages: OrderedDict[str, tuple[int, RenderedPage]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, proposal_id, version: int) -> RenderedPage | None:
+        key = str(proposal_id)
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, proposal_id, version: int, page: RenderedPage):
+        key = str(proposal_id)
+        with self._lock:
+            self._pages[key] = (version, page)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_size:
+                self._pages.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._pages), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+page_cache = PageCache()
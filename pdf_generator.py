@@ -1,4 +1,8 @@
+import io
 import os
+import threading
+from functools import lru_cache
+from pathlib import Path
 from datetime import datetime
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
@@ -25,8 +29,108 @@ COLOR_GRAY = colors.HexColor("#7F8C8D")
 COLOR_LIGHT_GRAY = colors.HexColor("#ECF0F1")
 COLOR_BG = colors.HexColor("#FAFAFA")
 
+# --- ШРИФТЫ (путь относительно модуля, а не CWD воркера) ---
+FONT_DIR = Path(__file__).parent / "assets" / "fonts"
+FONT_PATH = FONT_DIR / "DejaVuSans.ttf"
+FONT_BOLD_PATH = FONT_DIR / "DejaVuSans-Bold.ttf"
+
+_fonts_lock = threading.Lock()
+_fonts_registered = False
+
+def register_fonts():
+    """Парсит TTF и регистрирует шрифты в reportlab один раз на процесс."""
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    with _fonts_lock:
+        if _fonts_registered:
+            return
+        if FONT_PATH.exists():
+            pdfmetrics.registerFont(TTFont('DejaVu', str(FONT_PATH)))
+            if FONT_BOLD_PATH.exists():
+                pdfmetrics.registerFont(TTFont('DejaVu-Bold', str(FONT_BOLD_PATH)))
+            else:
+                pdfmetrics.registerFont(TTFont('DejaVu-Bold', str(FONT_PATH)))
+        else:
+            print("⚠️ ОШИБКА: ШРИФТ НЕ НАЙДЕН. PDF МОЖЕТ БЫТЬ СКОМПИЛИРОВАН С ОШИБКАМИ КИРИЛЛИЦЫ.")
+        _fonts_registered = True
+
+@lru_cache(maxsize=1)
+def get_styles():
+    """Общая для процесса таблица стилей (стили только читаются при сборке документа)."""
+    styles = getSampleStyleSheet()
+    
+    styles.add(ParagraphStyle(
+        name='CoverTitle',
+        fontName='DejaVu-Bold',
+        fontSize=32,
+        textColor=COLOR_PRIMARY,
+        alignment=TA_CENTER,
+        spaceAfter=1*cm
+    ))
+    
+    styles.add(ParagraphStyle(
+        name='CoverSubtitle',
+        fontName='DejaVu',
+        fontSize=16,
+        textColor=COLOR_GRAY,
+        alignment=TA_CENTER,
+        spaceAfter=2*cm
+    ))
+
+    styles.add(ParagraphStyle(
+        name='H1',
+        fontName='DejaVu-Bold',
+        fontSize=20,
+        textColor=COLOR_PRIMARY,
+        spaceAfter=0.5*cm,
+        spaceBefore=1*cm
+    ))
+
+    styles.add(ParagraphStyle(
+        name='H2',
+        fontName='DejaVu-Bold',
+        fontSize=16,
+        textColor=COLOR_ACCENT,
+        spaceAfter=0.3*cm,
+        spaceBefore=0.5*cm
+    ))
+
+    styles.add(ParagraphStyle(
+        name='NormalText',
+        fontName='DejaVu',
+        fontSize=10,
+        textColor=COLOR_TEXT,
+        leading=14,
+        spaceAfter=0.3*cm,
+        alignment=TA_JUSTIFY
+    ))
+    return styles
+
+# Стиль таблицы сметы одинаков для всех КП
+PLAN_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), COLOR_PRIMARY),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+    ('FONTNAME', (0, 0), (-1, 0), 'DejaVu-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 11),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
+    ('TOPPADDING', (0, 0), (-1, 0), 8),
+    # Zebra
+    ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white, COLOR_LIGHT_GRAY]),
+    # Итоговая строка
+    ('BACKGROUND', (0, -1), (-1, -1), COLOR_ACCENT),
+    ('TEXTCOLOR', (0, -1), (-1, -1), colors.white),
+    ('FONTNAME', (0, -1), (-1, -1), 'DejaVu-Bold'),
+    ('FONTSIZE', (0, -1), (-1, -1), 12),
+    ('GRID', (0,0), (-1,-1), 0.5, colors.white),
+    ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+])
+
 class PDFGenerator:
     def __init__(self, filename, proposal_id):
+        # filename — путь к файлу или файловый объект (например, io.BytesIO)
         self.filename = filename
         self.proposal_id = proposal_id
         self.doc = SimpleDocTemplate(
@@ -42,66 +146,10 @@ class PDFGenerator:
         self._setup_styles()
 
     def _register_fonts(self):
-        font_path = "assets/fonts/DejaVuSans.ttf"
-        font_bold_path = "assets/fonts/DejaVuSans-Bold.ttf"
-        
-        if os.path.exists(font_path):
-            pdfmetrics.registerFont(TTFont('DejaVu', font_path))
-            if os.path.exists(font_bold_path):
-                pdfmetrics.registerFont(TTFont('DejaVu-Bold', font_bold_path))
-            else:
-                pdfmetrics.registerFont(TTFont('DejaVu-Bold', font_path))
-        else:
-            print("⚠️ ОШИБКА: ШРИФТ НЕ НАЙДЕН. PDF МОЖЕТ БЫТЬ СКОМПИЛИРОВАН С ОШИБКАМИ КИРИЛЛИЦЫ.")
+        register_fonts()
 
     def _setup_styles(self):
-        self.styles = getSampleStyleSheet()
-        
-        self.styles.add(ParagraphStyle(
-            name='CoverTitle',
-            fontName='DejaVu-Bold',
-            fontSize=32,
-            textColor=COLOR_PRIMARY,
-            alignment=TA_CENTER,
-            spaceAfter=1*cm
-        ))
-        
-        self.styles.add(ParagraphStyle(
-            name='CoverSubtitle',
-            fontName='DejaVu',
-            fontSize=16,
-            textColor=COLOR_GRAY,
-            alignment=TA_CENTER,
-            spaceAfter=2*cm
-        ))
-
-        self.styles.add(ParagraphStyle(
-            name='H1',
-            fontName='DejaVu-Bold',
-            fontSize=20,
-            textColor=COLOR_PRIMARY,
-            spaceAfter=0.5*cm,
-            spaceBefore=1*cm
-        ))
-
-        self.styles.add(ParagraphStyle(
-            name='H2',
-            fontName='DejaVu-Bold',
-            fontSize=16,
-            textColor=COLOR_ACCENT,
-            spaceAfter=0.3*cm,
-            spaceBefore=0.5*cm
-        ))
-
-        self.styles.add(ParagraphStyle(
-            name='NormalText',
-            fontName='DejaVu',
-            fontSize=10,
-            textColor=COLOR_TEXT,
-            leading=14,
-            spaceAfter=0.3*cm,
-            alignment=TA_JUSTIFY
-        ))
+        self.styles = get_styles()
 
     def _header_footer(self, canvas, doc):
         canvas.saveState()
@@ -199,25 +247,7 @@ class PDFGenerator:
             
             # Стили таблицы
             t = Table(table_data, colWidths=[12*cm, 5*cm])
-            t.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), COLOR_PRIMARY),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-                ('FONTNAME', (0, 0), (-1, 0), 'DejaVu-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 11),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
-                ('TOPPADDING', (0, 0), (-1, 0), 8),
-                # Zebra
-                ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white, COLOR_LIGHT_GRAY]),
-                # Итоговая строка
-                ('BACKGROUND', (0, -1), (-1, -1), COLOR_ACCENT),
-                ('TEXTCOLOR', (0, -1), (-1, -1), colors.white),
-                ('FONTNAME', (0, -1), (-1, -1), 'DejaVu-Bold'),
-                ('FONTSIZE', (0, -1), (-1, -1), 12),
-                ('GRID', (0,0), (-1,-1), 0.5, colors.white),
-                ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ]))
+            t.setStyle(PLAN_TABLE_STYLE)
             
             self.elements.append(t)
             self.elements.append(Spacer(1, 1*cm))
@@ -237,3 +267,10 @@ class PDFGenerator:
 def generate_pdf(proposal_data: dict, filename: str, proposal_id: str):
     generator = PDFGenerator(filename, proposal_id)
     return generator.generate(proposal_data)
+
+def render_pdf_bytes(proposal_data: dict, proposal_id: str) -> bytes | None:
+    """Рендерит PDF в память (BytesIO) без промежуточного файла на диске."""
+    buffer = io.BytesIO()
+    if not PDFGenerator(buffer, proposal_id).generate(proposal_data):
+        return None
+    return buffer.getvalue()
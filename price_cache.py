@@ -0,0 +1,90 @@
+import os
+import time
+import logging
+import threading
+
+from duckduckgo_search import DDGS
+
+from database import get_cached_price, save_cached_price, get_cache_counters
+from counter_buffer import counter_buffer
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд цены считаются свежими. Устаревшие отдаются сразу и обновляются в фоне.
+PRICE_TTL = int(os.getenv("PRICE_CACHE_TTL", str(6 * 3600)))
+FALLBACK_CONTEXT = "Не удалось получить актуальные цены, используйте цены из базы."
+CACHE_NAME = "market_price"
+
+_refreshing: set[str] = set()
+_refreshing_lock = threading.Lock()
+
+
+def _fetch_market_price(model_name: str) -> str | None:
+    """Живой поиск цены через DuckDuckGo. None — если поиск не удался."""
+    try:
+        results = DDGS().text(f"купить котел {model_name} цена", max_results=3)
+        prices_context = "Найденные рыночные цены:\n"
+        for r in results:
+            prices_context += f"- {r.get('title')}: {r.get('body')}\n"
+        return prices_context
+    except Exception as e:
+        logger.warning(f"Ошибка поиска цены для {model_name}: {e}")
+        return None
+
+
+def refresh_price(model_name: str) -> str | None:
+    """Принудительно обновляет цену в кэше. Ошибки поиска не затирают старую запись."""
+    context = _fetch_market_price(model_name)
+    if context is not None:
+        save_cached_price(model_name, context, time.time())
+    return context
+
+
+def _refresh_in_background(model_name: str):
+    with _refreshing_lock:
+        if model_name in _refreshing:
+            return
+        _refreshing.add(model_name)
+
+    def worker():
+        try:
+            refresh_price(model_name)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(model_name)
+
+    threading.Thread(target=worker, name="price-refresh", daemon=True).start()
+
+
+def get_market_price(model_name: str) -> str:
+    """
+    Контекст рыночных цен для промпта (stale-while-revalidate):
+    свежая запись — сразу из кэша, устаревшая — сразу из кэша + фоновое обновление,
+    отсутствующая — живой поиск.
+    """
+    cached = get_cached_price(model_name)
+    if cached:
+        context, fetched_at = cached
+        if time.time() - fetched_at < PRICE_TTL:
+            counter_buffer.increment(CACHE_NAME, "hit")
+        else:
+            counter_buffer.increment(CACHE_NAME, "stale_hit")
+            _refresh_in_background(model_name)
+        return context
+
+    counter_buffer.increment(CACHE_NAME, "miss")
+    return refresh_price(model_name) or FALLBACK_CONTEXT
+
+
+def prewarm(models: list[str]) -> int:
+    """Обновляет цены для всего списка моделей. Возвращает число успешно обновленных."""
+    refreshed = 0
+    for model_name in models:
+        if refresh_price(model_name) is not None:
+            refreshed += 1
+    logger.info(f"🔥 Прогрев кэша цен: обновлено {refreshed} из {len(models)}")
+    return refreshed
+
+
+def stats() -> dict:
+    return get_cache_counters(CACHE_NAME).get(CACHE_NAME, {})
@@ -0,0 +1,67 @@
+import os
+import time
+import logging
+
+from telegram_client import get_telegram_client, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Не чаще одного редактирования сообщения за столько секунд (лимит Bot API ~1/с на чат)
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "2.0"))
+SUMMARY_PREVIEW_CHARS = 300
+
+
+class ProgressReporter:
+    """
+    Живой прогресс генерации в чате: одно сообщение "Принято в работу" редактируется
+    по мере того, как модель дописывает разделы КП (заголовок, резюме, тарифы).
+    Правки троттлятся; пропущенные разделы попадут в следующую правку или в finish().
+    """
+
+    def __init__(self, chat_id, message_id: int, proposal_id):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.proposal_id = proposal_id
+        self.sections: dict = {}
+        self._last_edit = 0.0
+        self._last_text = None
+
+    def on_field(self, field: str, value):
+        if field not in ("title", "executive_summary", "plans"):
+            return
+        self.sections[field] = value
+        if time.monotonic() - self._last_edit >= PROGRESS_EDIT_INTERVAL:
+            self._edit(self._render("⏳ Генерация идет..."))
+
+    def finish(self, status: str):
+        """Финальная правка: итог генерации поверх последних полученных разделов."""
+        self._edit(self._render(status))
+
+    def _render(self, status: str) -> str:
+        lines = [f"📝 КП #{self.proposal_id}", status]
+        title = self.sections.get("title")
+        if title:
+            lines += ["", f"📌 {title}"]
+        summary = self.sections.get("executive_summary")
+        if summary:
+            if len(summary) > SUMMARY_PREVIEW_CHARS:
+                summary = summary[:SUMMARY_PREVIEW_CHARS].rstrip() + "…"
+            lines += ["", summary]
+        plans = self.sections.get("plans")
+        if isinstance(plans, list) and plans:
+            lines += ["", "💰 Тарифы:"]
+            for plan in plans:
+                if isinstance(plan, dict):
+                    lines.append(f"• {plan.get('name', '—')}: {plan.get('total_price', '—')}")
+        return "\n".join(lines)
+
+    def _edit(self, text: str):
+        self._last_edit = time.monotonic()
+        if text == self._last_text:
+            return  # Telegram отвечает 400 "message is not modified"
+        try:
+            # Без parse_mode: текст модели может сломать разметку
+            get_telegram_client().edit_message_text(self.chat_id, self.message_id, text)
+            self._last_text = text
+        except TelegramError as e:
+            logger.warning(f"⚠️ Не удалось обновить прогресс КП #{self.proposal_id}: {e}")
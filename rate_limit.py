@@ -0,0 +1,199 @@
+import os
+import time
+import hashlib
+import json
+import logging
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL")
+# Сколько прокси стоит перед uvicorn (Railway — один): IP клиента берем из X-Forwarded-For
+FORWARDED_HOPS = int(os.getenv("FORWARDED_HOPS", "1"))
+# Одинаковое событие (КП, тип, метаданные) чаще, чем раз в окно, — дубль
+TRACK_DEDUP_WINDOW = int(os.getenv("TRACK_DEDUP_WINDOW", "5"))
+
+_PERIODS = {"sec": 1, "min": 60, "hour": 3600}
+
+
+def parse_limit(spec: str) -> tuple[float, int]:
+    """'120/min' -> (токенов в секунду, емкость ведра). Емкость = N: всплеск до N запросов сразу."""
+    count, _, period = spec.partition("/")
+    return int(count) / _PERIODS[period or "sec"], int(count)
+
+
+# Лимиты на эндпоинт: по IP и по КП. /ai стоит платного запроса к LLM — он строже.
+LIMITS = {
+    "track": {
+        "ip": parse_limit(os.getenv("RATE_LIMIT_TRACK_IP", "120/min")),
+        "proposal": parse_limit(os.getenv("RATE_LIMIT_TRACK_PROPOSAL", "120/min")),
+    },
+    "ai": {
+        "ip": parse_limit(os.getenv("RATE_LIMIT_AI_IP", "6/min")),
+        "proposal": parse_limit(os.getenv("RATE_LIMIT_AI_PROPOSAL", "30/hour")),
+    },
+}
+
+# Все ведра запроса проверяются и списываются атомарно: либо пропускаем по всем, либо ни по одному.
+# KEYS — ведра; ARGV[1] — сейчас (мс), далее пары (скорость в токенах/мс, емкость).
+# Ответ: {1, 0} — пропущен, {0, мс до появления токена} — отказ.
+TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local capacity = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local t = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    t = math.min(capacity, t + math.max(0, now - ts) * rate)
+    tokens[i] = t
+    if t < 1 then
+        wait = math.max(wait, (1 - t) / rate)
+    end
+end
+if wait > 0 then
+    return {0, math.ceil(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local capacity = tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', key, 'tokens', tostring(tokens[i] - 1), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate) + 1000)
+end
+return {1, 0}
+"""
+
+
+class LocalLimiter:
+    """Те же ведра и дедуп в памяти процесса — запасной вариант, пока Redis недоступен."""
+
+    MAX_KEYS = 50000
+
+    def __init__(self):
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._seen: dict[str, float] = {}
+
+    def acquire(self, buckets: list[tuple[str, float, int]]) -> float:
+        now = time.monotonic()
+        wait = 0.0
+        refilled = []
+        for key, rate, capacity in buckets:
+            tokens, ts = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            refilled.append(tokens)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+        if wait > 0:
+            return wait
+        for (key, _, _), tokens in zip(buckets, refilled):
+            self._buckets[key] = (tokens - 1, now)
+        if len(self._buckets) > self.MAX_KEYS:
+            # Полные ведра ничего не помнят — их можно выбросить
+            self._buckets = {
+                k: v for k, v in self._buckets.items() if now - v[1] < 3600
+            }
+        return 0.0
+
+    def first_seen(self, key: str, window: int) -> bool:
+        now = time.monotonic()
+        if self._seen.get(key, 0) > now:
+            return False
+        self._seen[key] = now + window
+        if len(self._seen) > self.MAX_KEYS:
+            self._seen = {k: v for k, v in self._seen.items() if v > now}
+        return True
+
+
+class RateLimiter:
+    """
+    Токен-ведра в Redis (тот же инстанс, что у Celery) — общие для всех процессов API.
+    Если Redis не настроен или упал, лимитирует локально, чтобы перегрузка
+    все равно не доходила до SQLite и LLM.
+    """
+
+    def __init__(self, url: str | None = REDIS_URL):
+        self.redis = aioredis.Redis.from_url(url) if url else None
+        self._script = self.redis.register_script(TOKEN_BUCKET_LUA) if self.redis else None
+        self.local = LocalLimiter()
+        self.limited_total = 0
+        self.deduped_total = 0
+        self.fallback_total = 0
+
+    def _fallback(self, e: Exception):
+        if self.fallback_total % 100 == 0:
+            logger.warning(f"⚠️ Redis недоступен для лимитов, работаем локально: {e}")
+        self.fallback_total += 1
+
+    async def acquire(self, buckets: list[tuple[str, float, int]]) -> float:
+        """Списывает по токену из каждого ведра. 0 — пропущен, иначе через сколько секунд повторить."""
+        wait = None
+        if self._script is not None:
+            try:
+                args = [int(time.time() * 1000)]
+                for _, rate, capacity in buckets:
+                    args += [rate / 1000, capacity]
+                allowed, wait_ms = await self._script(keys=[key for key, _, _ in buckets], args=args)
+                wait = 0.0 if allowed else wait_ms / 1000
+            except RedisError as e:
+                self._fallback(e)
+        if wait is None:
+            wait = self.local.acquire(buckets)
+        if wait > 0:
+            self.limited_total += 1
+        return wait
+
+    async def first_seen(self, key: str, window: int = TRACK_DEDUP_WINDOW) -> bool:
+        """SET NX EX: True для первого события в окне, False — для дубля."""
+        seen = None
+        if self.redis is not None:
+            try:
+                seen = bool(await self.redis.set(key, 1, nx=True, ex=window))
+            except RedisError as e:
+                self._fallback(e)
+        if seen is None:
+            seen = self.local.first_seen(key, window)
+        if not seen:
+            self.deduped_total += 1
+        return seen
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis" if self.redis is not None else "local",
+            "limited_total": self.limited_total,
+            "deduped_total": self.deduped_total,
+            "fallback_total": self.fallback_total,
+        }
+
+
+def client_ip(request) -> str:
+    """IP клиента за FORWARDED_HOPS доверенными прокси (правые записи X-Forwarded-For добавили они)."""
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded and FORWARDED_HOPS > 0:
+        hops = [part.strip() for part in forwarded.split(",") if part.strip()]
+        if len(hops) >= FORWARDED_HOPS:
+            return hops[-FORWARDED_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+def buckets_for(endpoint: str, ip: str, proposal_id) -> list[tuple[str, float, int]]:
+    limits = LIMITS[endpoint]
+    return [
+        (f"rl:{endpoint}:ip:{ip}", *limits["ip"]),
+        (f"rl:{endpoint}:p:{proposal_id}", *limits["proposal"]),
+    ]
+
+
+def dedup_key(proposal_id, event_type: str, metadata: dict | None) -> str:
+    digest = hashlib.sha1(json.dumps(metadata or {}, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+    return f"dedup:{proposal_id}:{event_type}:{digest}"
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,62 @@
+import os
+import json
+
+import redis
+
+REDIS_URL = os.getenv("REDIS_URL")
+# Пересчет стартует, только если за это время по КП не пришло новой правки
+RECALC_DEBOUNCE = float(os.getenv("RECALC_DEBOUNCE", "5"))
+SPEC_TTL = 3600
+SEQ_TTL = 30 * 24 * 3600
+
+# Каждая просьба о пересчете получает порядковый номер (INCR) и свое ТЗ под этим номером.
+# Выполняется только задача с последним номером, а результат старого номера отбрасывается —
+# так частые правки клиента дают один пересчет по последнему ТЗ, а не гонку генераций.
+_client: redis.Redis | None = None
+_client_pid: int | None = None
+
+
+def _redis() -> redis.Redis:
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = redis.Redis.from_url(REDIS_URL)
+        _client_pid = os.getpid()
+    return _client
+
+
+def _seq_key(proposal_id) -> str:
+    return f"recalc:{proposal_id}:seq"
+
+
+def _spec_key(proposal_id, seq: int) -> str:
+    return f"recalc:{proposal_id}:spec:{seq}"
+
+
+def schedule(proposal_id, client: str, task: str, chat_id, min_seq: int = 0) -> int:
+    """
+    Регистрирует новое ТЗ пересчета и возвращает его номер. min_seq — номер, уже
+    записанный в БД: если Redis потерял счетчик, номера продолжатся после него.
+    """
+    r = _redis()
+    seq = r.incr(_seq_key(proposal_id))
+    if seq <= min_seq:
+        seq = r.incrby(_seq_key(proposal_id), min_seq - seq + 1)
+    r.expire(_seq_key(proposal_id), SEQ_TTL)
+    # ТЗ хранится под своим номером: параллельные запросы не перезапишут чужое
+    spec = {"client": client, "task": task, "chat_id": chat_id}
+    r.set(_spec_key(proposal_id, seq), json.dumps(spec, ensure_ascii=False), ex=SPEC_TTL)
+    return seq
+
+
+def latest(proposal_id) -> int:
+    value = _redis().get(_seq_key(proposal_id))
+    return int(value) if value else 0
+
+
+def is_current(proposal_id, seq: int) -> bool:
+    return latest(proposal_id) == seq
+
+
+def load_spec(proposal_id, seq: int) -> dict | None:
+    raw = _redis().get(_spec_key(proposal_id, seq))
+    return json.loads(raw) if raw else None
@@ -5,8 +5,13 @@ import logging
 from google import genai
 from google.genai import types
 
+from model_router import router, hedge_delay_from_env
+
 logger = logging.getLogger(__name__)
 
+# Анализ продаж — полный платный вызов, а sync-хедж не отменить: по умолчанию без хеджа
+SALES_HEDGE_DELAY = hedge_delay_from_env("AI_SALES_HEDGE_DELAY")
+
 
 def clean_json(content):
 
@@ -69,25 +74,26 @@ def analyze_sales(prompt):
         "gemini-pro", # Более стабильная модель в качестве запасного варианта
     ]
 
-    for model_name in models_to_try:
-        try:
-            logger.info(f"Анализ продаж через модель: {model_name}")
-            response = client.models.generate_content(
-                model=model_name,
-                contents=analysis_prompt,
-                config=types.GenerateContentConfig(
-                    temperature=0.2
-                )
+    def analyze(model_name):
+        logger.info(f"Анализ продаж через модель: {model_name}")
+        response = client.models.generate_content(
+            model=model_name,
+            contents=analysis_prompt,
+            config=types.GenerateContentConfig(
+                temperature=0.2
             )
+        )
+
+        data = clean_json(response.text) if response.text else None
+        if not data or "probability" not in data:
+            raise ValueError("ответ без анализа продаж")
+        return data
 
-            if response.text:
-                data = clean_json(response.text)
-                if data and "probability" in data:
-                    return data
-            
-        except Exception as e:
-            logger.warning(f"Ошибка модели {model_name} в sales_analyzer: {e}")
-            continue # Пробуем следующую модель
+    # Роутер пробует модели от самой быстрой здоровой; при неудаче — следующую
+    try:
+        return router.call(models_to_try, analyze, hedge_delay=SALES_HEDGE_DELAY)
+    except Exception as e:
+        logger.warning(f"Ошибка моделей в sales_analyzer: {e}")
 
     logger.error("Ни одна из моделей не смогла выполнить анализ продаж.")
     return None
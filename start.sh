@@ -7,7 +7,16 @@ sleep 2
 python bot.py &
 
 # 2. Запуск Celery-воркера для тяжелых задач (генерация КП, AI, PDF) в фоновом режиме
-celery -A celery_worker.celery_app worker --loglevel=info &
+#    -B: встроенный beat для периодических задач (прогрев кэша цен)
+#    ASYNC_WORKER_MODE=1: один процесс с пулом потоков, генерации мультиплексируются на общем event loop
+if [ "${ASYNC_WORKER_MODE:-0}" = "1" ]; then
+    celery -A celery_worker.celery_app worker -B -P threads -c ${WORKER_CONCURRENCY:-50} --loglevel=info &
+else
+    celery -A celery_worker.celery_app worker -B --loglevel=info &
+fi
+
+# 2.1. Публикатор GitHub Pages: один процесс с потоками, чтобы страницы батчились в общий коммит
+celery -A celery_worker.celery_app worker -Q publish -P threads -c 16 -n publish@%h --loglevel=info &
 
 # 3. Запуск FastAPI-сервера (для обработки вебхуков телеметрии и AI-агента с фронтенда)
 uvicorn web_server:app --host 0.0.0.0 --port ${PORT:-8080}
\ No newline at end of file
@@ -0,0 +1,208 @@
+import io
+import os
+import time
+import asyncio
+import logging
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+API_URL = "https://api.telegram.org/bot{token}/{method}"
+
+# Лимиты Bot API: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+PER_CHAT_INTERVAL = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL", "1.0"))
+MAX_ATTEMPTS = 5
+REQUEST_TIMEOUT = 30
+
+
+class TelegramError(Exception):
+    def __init__(self, method: str, description: str, status_code: int | None = None):
+        super().__init__(f"{method}: {description}")
+        self.method = method
+        self.description = description
+        self.status_code = status_code
+
+
+class RateLimiter:
+    """
+    Резервирует слоты отправки: глобальный (GLOBAL_RATE/с на процесс) и на чат.
+    Возвращает, сколько ждать до своего слота; ждать вызывающий будет сам —
+    time.sleep в воркерах или asyncio.sleep в API-сервере.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL):
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.per_chat_interval = per_chat_interval
+        self._next_global = 0.0
+        self._next_chat: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, chat_id=None) -> float:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_global)
+            if chat_id is not None:
+                slot = max(slot, self._next_chat.get(str(chat_id), 0.0))
+                self._next_chat[str(chat_id)] = slot + self.per_chat_interval
+            self._next_global = slot + self.global_interval
+            if len(self._next_chat) > 10000:
+                # Чаты, чей слот давно прошел, больше не ограничивают — чистим словарь
+                self._next_chat = {k: v for k, v in self._next_chat.items() if v > now}
+            return slot - now
+
+    def penalize(self, chat_id, seconds: float):
+        """После 429 сдвигаем слоты чата (и глобальный) на retry_after."""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if chat_id is not None:
+                self._next_chat[str(chat_id)] = max(self._next_chat.get(str(chat_id), 0.0), until)
+            self._next_global = max(self._next_global, until)
+
+
+def _retry_delay(status_code: int, payload: dict | None, attempt: int) -> float | None:
+    """Пауза перед повтором или None, если повторять бессмысленно."""
+    if status_code == 429:
+        return float((payload or {}).get("parameters", {}).get("retry_after", 1))
+    if status_code >= 500:
+        return min(2 ** attempt, 30)
+    return None
+
+
+def _safe_json(response) -> dict | None:
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+class TelegramClient:
+    """
+    Синхронный клиент Bot API для Celery-воркеров: keep-alive пул соединений,
+    лимиты на чат и глобально, повторы с учетом retry_after, проверка поля ok.
+    """
+
+    def __init__(self, token: str = BOT_TOKEN, limiter: RateLimiter | None = None):
+        self.token = token
+        self.limiter = limiter or RateLimiter()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+
+    def call(self, method: str, chat_id=None, data: dict = None, files: dict = None) -> dict:
+        url = API_URL.format(token=self.token, method=method)
+        for attempt in range(MAX_ATTEMPTS):
+            delay = self.limiter.reserve(chat_id)
+            if delay > 0:
+                time.sleep(delay)
+            # Файловые объекты перематываем: при повторе multipart читается заново
+            for _, fileobj in (files or {}).values():
+                if hasattr(fileobj, "seek"):
+                    fileobj.seek(0)
+            try:
+                if files:
+                    response = self.session.post(url, data=data, files=files, timeout=REQUEST_TIMEOUT)
+                else:
+                    response = self.session.post(url, json=data, timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"⚠️ Telegram {method}: сетевая ошибка (попытка {attempt + 1}/{MAX_ATTEMPTS}): {e}")
+                time.sleep(min(2 ** attempt, 30))
+                continue
+
+            payload = _safe_json(response)
+            if response.status_code == 200 and payload and payload.get("ok"):
+                return payload.get("result")
+
+            retry_in = _retry_delay(response.status_code, payload, attempt)
+            if retry_in is None or attempt == MAX_ATTEMPTS - 1:
+                description = (payload or {}).get("description", response.text[:200])
+                raise TelegramError(method, description, response.status_code)
+            if response.status_code == 429:
+                self.limiter.penalize(chat_id, retry_in)
+                logger.warning(f"⏳ Telegram 429 ({method}), повтор через {retry_in}s")
+            else:
+                time.sleep(retry_in)
+        raise TelegramError(method, "исчерпаны попытки отправки")
+
+    def send_message(self, chat_id, text: str, parse_mode: str | None = None, **params) -> dict:
+        data = {"chat_id": chat_id, "text": text, **params}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        return self.call("sendMessage", chat_id, data)
+
+    def edit_message_text(self, chat_id, message_id: int, text: str, parse_mode: str | None = None) -> dict:
+        data = {"chat_id": chat_id, "message_id": message_id, "text": text}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        return self.call("editMessageText", chat_id, data)
+
+    def send_document(self, chat_id, document, filename: str, caption: str | None = None) -> dict:
+        """document — bytes или файловый объект. requests собирает multipart-тело целиком в памяти,
+        поэтому файл должен помещаться в память (PDF КП — сотни КБ)."""
+        if isinstance(document, (bytes, bytearray)):
+            document = io.BytesIO(document)
+        data = {"chat_id": chat_id}
+        if caption:
+            data["caption"] = caption
+        return self.call("sendDocument", chat_id, data, files={"document": (filename, document)})
+
+
+class AsyncTelegramClient:
+    """Асинхронный вариант для FastAPI поверх общего httpx.AsyncClient."""
+
+    def __init__(self, http_client: httpx.AsyncClient, token: str = BOT_TOKEN, limiter: RateLimiter | None = None):
+        self.http = http_client
+        self.token = token
+        self.limiter = limiter or RateLimiter()
+
+    async def call(self, method: str, chat_id=None, data: dict = None) -> dict:
+        url = API_URL.format(token=self.token, method=method)
+        for attempt in range(MAX_ATTEMPTS):
+            delay = self.limiter.reserve(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                response = await self.http.post(url, json=data, timeout=REQUEST_TIMEOUT)
+            except httpx.HTTPError as e:
+                logger.warning(f"⚠️ Telegram {method}: сетевая ошибка (попытка {attempt + 1}/{MAX_ATTEMPTS}): {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+
+            payload = _safe_json(response)
+            if response.status_code == 200 and payload and payload.get("ok"):
+                return payload.get("result")
+
+            retry_in = _retry_delay(response.status_code, payload, attempt)
+            if retry_in is None or attempt == MAX_ATTEMPTS - 1:
+                description = (payload or {}).get("description", response.text[:200])
+                raise TelegramError(method, description, response.status_code)
+            if response.status_code == 429:
+                self.limiter.penalize(chat_id, retry_in)
+                logger.warning(f"⏳ Telegram 429 ({method}), повтор через {retry_in}s")
+            else:
+                await asyncio.sleep(retry_in)
+        raise TelegramError(method, "исчерпаны попытки отправки")
+
+    async def send_message(self, chat_id, text: str, parse_mode: str | None = None, **params) -> dict:
+        data = {"chat_id": chat_id, "text": text, **params}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        return await self.call("sendMessage", chat_id, data)
+
+
+_client: TelegramClient | None = None
+_client_pid: int | None = None
+
+
+def get_telegram_client() -> TelegramClient:
+    """Клиент текущего процесса (после fork Celery создается заново, чтобы не делить сокеты)."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = TelegramClient()
+        _client_pid = os.getpid()
+    return _client
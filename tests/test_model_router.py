@@ -0,0 +1,49 @@
+import time
+
+from model_router import ModelRouter, ROUTER_MIN_SAMPLES
+
+
+def _timed_fn(latencies: dict[str, float], calls: list[str]):
+    def fn(model: str) -> str:
+        calls.append(model)
+        time.sleep(latencies[model])
+        return model
+    return fn
+
+
+def test_unmeasured_models_rank_first():
+    router = ModelRouter(explore_rate=0)
+    for _ in range(ROUTER_MIN_SAMPLES):
+        router.record("primary", 0.5, True)
+    assert router.ranked(["primary", "secondary"]) == ["secondary", "primary"]
+
+
+def test_faster_secondary_gets_promoted_without_hedging():
+    router = ModelRouter(explore_rate=0)
+    calls = []
+    fn = _timed_fn({"slow": 0.03, "fast": 0.005}, calls)
+
+    for _ in range(2 * ROUTER_MIN_SAMPLES + 5):
+        router.call(["slow", "fast"], fn, hedge_delay=None)
+
+    # Обе модели замерены, дальше все вызовы уходят быстрой
+    assert calls.count("slow") == ROUTER_MIN_SAMPLES
+    assert calls[-5:] == ["fast"] * 5
+    assert router.pick(["slow", "fast"]) == "fast"
+
+
+def test_probe_refreshes_losing_model():
+    router = ModelRouter(explore_rate=1.0)
+    for _ in range(ROUTER_MIN_SAMPLES):
+        router.record("slow", 0.5, True)
+        router.record("fast", 0.01, True)
+    assert router.ranked(["slow", "fast"])[0] == "slow"
+    assert router.stats()["probes_total"] == 1
+
+
+def test_unhealthy_model_is_not_probed():
+    router = ModelRouter(explore_rate=1.0)
+    for _ in range(ROUTER_MIN_SAMPLES):
+        router.record("fast", 0.01, True)
+    router.record("broken", 0.01, False)
+    assert router.ranked(["fast", "broken"]) == ["fast", "broken"]
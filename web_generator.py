@@ -1,16 +1,24 @@
 import os
+import uuid
+import hashlib
+from pathlib import Path
 from jinja2 import Environment, FileSystemLoader
 from github_pages import upload_page
 
 # URL вашего API-сервера на Railway. Должен быть в .env
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8080")
 
-# Настраиваем Jinja2 для загрузки шаблонов из текущей директории
-env = Environment(loader=FileSystemLoader('.'))
+# Настраиваем Jinja2 для загрузки шаблонов из папки проекта (не зависит от CWD)
+TEMPLATE_DIR = Path(__file__).parent
+env = Environment(loader=FileSystemLoader(str(TEMPLATE_DIR)))
 template = env.get_template("proposal_template.html")
 
+# Ревизия шаблона: входит в ETag, чтобы после деплоя нового шаблона кэши браузеров сбросились
+TEMPLATE_REV = hashlib.sha1((TEMPLATE_DIR / "proposal_template.html").read_bytes()).hexdigest()[:8]
 
-def generate_page(proposal_id: str, client: str, task: str, proposal_data: dict):
+
+def render_page(proposal_id: str, client: str, task: str, proposal_data: dict, build_id: str) -> str:
+    """Рендерит HTML страницы КП из шаблона proposal_template.html."""
     # Добавляем total_price к каждому плану, если его нет
     for plan in proposal_data.get("plans", []):
         if "total_price" not in plan:
@@ -29,20 +37,32 @@ def generate_page(proposal_id: str, client: str, task: str, proposal_data: dict)
     mermaid_code = proposal_data.get("mermaid_graph", fallback_graph)
 
     # Рендерим шаблон
-    final_html = template.render(
+    return template.render(
         proposal_id=proposal_id,
         client=client,
         task=task,
         plans=proposal_data.get("plans", []), # <--- ИСПРАВЛЕНИЕ ЗДЕСЬ! Передаем список данных.
         backend_url=BACKEND_URL,
-        mermaid_graph=mermaid_code # Передаем сгенерированную схему
+        mermaid_graph=mermaid_code, # Передаем сгенерированную схему
+        build_id=build_id
     )
 
+
+def generate_page(proposal_id: str, client: str, task: str, proposal_data: dict) -> str | None:
+    """
+    Рендерит страницу КП и публикует ее на GitHub Pages.
+    Возвращает метку сборки (build_id), по которой можно проверить, что опубликованная
+    страница обновилась, или None, если загрузка не удалась.
+    """
+    build_id = uuid.uuid4().hex[:12]
+    final_html = render_page(proposal_id, client, task, proposal_data, build_id)
+
     # 4. Сохраняем и загружаем на GitHub (через ваш github_pages.py)
     file_path = f"{proposal_id}.html"
-    upload_page(file_path, final_html)
+    if not upload_page(file_path, final_html):
+        return None
     
-    return True
+    return build_id
 
 def str_is_comma(s):
     return s == ','
@@ -1,20 +1,41 @@
 import os
+import hmac
+import math
+import time
 import logging
 import json
-import requests
-from fastapi import FastAPI
+import asyncio
+import httpx
+from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from google import genai
 from google.genai import types
 
-from database import get_proposal_data, log_event
-from celery_worker import task_generate_proposal
+from async_database import (
+    get_proposal_data, get_proposal_version, get_proposal_page_data, get_cache_counters,
+    get_proposal_recalc_info, get_proposal_analytics, close_connection
+)
+from database import init_db
+from event_buffer import event_buffer
+from notifier import dispatcher
+from celery_worker import task_recalculate_proposal
+from web_generator import render_page, TEMPLATE_REV
+from page_cache import page_cache, page_etag, http_date, RenderedPage
+from json_stream import IncrementalJSONObject
+from model_router import router, hedge_delay_from_env
+from rate_limit import rate_limiter, client_ip, buckets_for, dedup_key
+import recalc
 
 # --- CONFIGURATION ---
-BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-MANAGER_ID = os.getenv("MANAGER_TELEGRAM_ID")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# Модели помощника на странице КП: роутер берет самую быструю здоровую и хеджирует второй
+ASSISTANT_MODELS = os.getenv("AI_ASSISTANT_MODELS", "gemma-3-27b-it,gemini-2.5-flash").split(",")
+# Ответ помощника короткий, а проигравший хедж отменяется: хеджируем после p95, но не раньше этой задержки
+ASSISTANT_HEDGE_DELAY = hedge_delay_from_env("AI_ASSISTANT_HEDGE_DELAY", "1.5")
+# Токен менеджера для закрытых эндпоинтов (Authorization: Bearer <токен>); не задан — они выключены
+MANAGER_API_TOKEN = os.getenv("MANAGER_API_TOKEN")
 
 logger = logging.getLogger(__name__)
 
@@ -40,51 +61,81 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- HELPER FUNCTIONS ---
-def notify(text: str):
-    """Синхронно отправляет уведомление в Telegram."""
-    if not BOT_TOKEN or not MANAGER_ID:
-        logger.error("TELEGRAM_BOT_TOKEN или MANAGER_TELEGRAM_ID не установлены!")
-        return
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        payload = {"chat_id": MANAGER_ID, "text": text, "parse_mode": "Markdown"}
-        response = requests.post(url, json=payload, timeout=5)
-        response.raise_for_status()
-        logger.info(f"Уведомление успешно отправлено: {text}")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при отправке уведомления в Telegram: {e}")
+# Общий пул keep-alive соединений для исходящих HTTP-запросов и общий клиент GenAI
+http_client: httpx.AsyncClient | None = None
+genai_client: genai.Client | None = None
+
+@app.on_event("startup")
+async def startup():
+    global http_client, genai_client
+    # Миграции схемы до первого запроса; параллельный старт бота/воркера подождет блокировку
+    await asyncio.to_thread(init_db)
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(5.0),
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=10)
+    )
+    genai_client = genai.Client(api_key=GOOGLE_API_KEY)
+    event_buffer.start()
+    dispatcher.start(http_client)
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Дописываем в БД все накопленные события перед остановкой воркера
+    await asyncio.to_thread(event_buffer.stop)
+    await dispatcher.stop()
+    await rate_limiter.close()
+    await http_client.aclose()
+    await close_connection()
 
 # --- API ENDPOINTS ---
+async def enforce_rate_limit(endpoint: str, request: Request, proposal_id):
+    """429 с Retry-After, если исчерпано ведро IP или КП — до записи в БД и вызова LLM"""
+    retry_after = await rate_limiter.acquire(buckets_for(endpoint, client_ip(request), proposal_id))
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Слишком много запросов, попробуйте позже",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+def require_manager(request: Request):
+    """401 без верного токена менеджера; 404, если токен не настроен и закрытые эндпоинты выключены"""
+    if not MANAGER_API_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), MANAGER_API_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Нужен токен менеджера", headers={"WWW-Authenticate": "Bearer"})
+
 @app.post("/track")
-def track_client_action(event: TrackEvent):
+async def track_client_action(event: TrackEvent, request: Request):
     """Сбор Heatmap и событий"""
-    log_event(event.proposal_id, event.event_type, event.metadata)
+    await enforce_rate_limit("track", request, event.proposal_id)
+    # Повтор того же события (двойной клик, переотправка) в окне дедупа не пишем и не уведомляем
+    if not await rate_limiter.first_seen(dedup_key(event.proposal_id, event.event_type, event.metadata)):
+        return {"status": "duplicate"}
+
+    event_buffer.push(event.proposal_id, event.event_type, event.metadata)
     
-    # AI Co-pilot: уведомляем менеджера о важных шагах
+    # AI Co-pilot: уведомляем менеджера о важных шагах (только постановка в очередь)
+    metadata = event.metadata or {}
     if event.event_type == "scrolled_80":
-        notify(f"🔥 Клиент долистал КП `#{event.proposal_id}` до конца!")
+        dispatcher.enqueue(event.proposal_id, f"🔥 Клиент долистал КП `#{event.proposal_id}` до конца!")
     elif event.event_type == "plan_clicked":
-        plan_name = event.metadata.get("plan_name", "")
-        notify(f"👍 Клиент проявил интерес к тарифу **{plan_name}** в КП `#{event.proposal_id}`!")
+        plan_name = metadata.get("plan_name", "")
+        dispatcher.enqueue(event.proposal_id, f"👍 Клиент проявил интерес к тарифу **{plan_name}** в КП `#{event.proposal_id}`!")
     elif event.event_type == "pay_advance_clicked":
-        plan_name = event.metadata.get("plan_name", "")
-        price = event.metadata.get("price", "")
-        notify(f"🤑 **ВНИМАНИЕ!** Клиент нажал кнопку **Внести аванс** ({plan_name}, {price}) в КП `#{event.proposal_id}`! СРОЧНО свяжитесь с ним!")
+        plan_name = metadata.get("plan_name", "")
+        price = metadata.get("price", "")
+        dispatcher.enqueue(event.proposal_id, f"🤑 **ВНИМАНИЕ!** Клиент нажал кнопку **Внести аванс** ({plan_name}, {price}) в КП `#{event.proposal_id}`! СРОЧНО свяжитесь с ним!", urgent=True)
     elif event.event_type == "viewing_plans_long":
-        notify(f"👀 Клиент уже 10 секунд изучает тарифы в КП `#{event.proposal_id}`. Самое время предложить скидку!")
+        dispatcher.enqueue(event.proposal_id, f"👀 Клиент уже 10 секунд изучает тарифы в КП `#{event.proposal_id}`. Самое время предложить скидку!")
         
     return {"status": "ok"}
 
-@app.post("/ai")
-async def ai_chat(q: Question):
-    """Умный AI-помощник: Общение + Пересчет КП"""
-    log_event(q.proposal_id, "ai_question", {"question": q.question})
-    notify(f"💬 Вопрос по КП `#{q.proposal_id}`:\n_{q.question}_")
-    
-    current_kp = get_proposal_data(q.proposal_id)
-    
-    prompt = f"""
+AI_ERROR_ANSWER = "Ой, я немного запутался. Менеджер скоро свяжется с вами!"
+
+def _assistant_prompt(q: Question, current_kp: dict) -> str:
+    return f"""
     Ты - AI инженер по продажам. Клиент задал вопрос по коммерческому предложению (ID: {q.proposal_id}).
     Текущие данные КП: {json.dumps(current_kp, ensure_ascii=False)[:500]}...
     Вопрос клиента: "{q.question}"
@@ -100,33 +151,184 @@ async def ai_chat(q: Question):
         "new_task_context": "если action=recalculate, напиши сюда новое ТЗ для генератора (например: Дом 200м2, нужен теплый пол), иначе null"
     }}
     """
+
+async def _start_question(q: Question) -> tuple[dict, str]:
+    """Телеметрия + уведомление менеджеру, затем текущий КП и промпт помощника"""
+    event_buffer.push(q.proposal_id, "ai_question", {"question": q.question})
+    dispatcher.enqueue(q.proposal_id, f"💬 Вопрос по КП `#{q.proposal_id}`:\n_{q.question}_")
+    current_kp = await get_proposal_data(q.proposal_id)
+    return current_kp, _assistant_prompt(q, current_kp)
+
+def _schedule_recalculation(proposal_id: int, client: str, task: str, chat_id: int, min_seq: int) -> int:
+    """
+    Регистрирует ТЗ пересчета и откладывает задачу на RECALC_DEBOUNCE секунд: если клиент
+    успеет прислать еще правку, выполнится только задача с последним номером.
+    Redis синхронный — вызывается через to_thread.
+    """
+    seq = recalc.schedule(proposal_id, client, task, chat_id, min_seq)
+    task_recalculate_proposal.apply_async((proposal_id, seq), countdown=recalc.RECALC_DEBOUNCE)
+    return seq
+
+async def _apply_decision(q: Question, current_kp: dict, ai_decision: dict) -> dict:
+    """Исполняет решение модели (ответ или пересчет) и возвращает ответ для страницы"""
+    if ai_decision.get("action") == "recalculate":
+        new_task = ai_decision.get("new_task_context")
+        info = await get_proposal_recalc_info(int(q.proposal_id)) if new_task else None
+        if info:
+            # Результат уходит владельцу КП, а клиент берется из БД, а не из пересказа модели
+            seq = await asyncio.to_thread(
+                _schedule_recalculation, int(q.proposal_id), info["client"] or current_kp.get('client_name', 'Клиент'),
+                new_task, info["user_id"], info["spec_seq"]
+            )
+            event_buffer.push(q.proposal_id, "recalculation_triggered", {"new_task": new_task, "seq": seq})
+            dispatcher.enqueue(q.proposal_id, f"🔄 **Клиент запустил пересчет КП #{q.proposal_id}!**\nНовое ТЗ: {new_task}", urgent=True)
+            
+            return {
+                "answer": ai_decision.get("reply_text", "Принял. Пересчитываю...") + " Страница обновится через 15-20 секунд.",
+                "action": "recalculate"
+            }
     
-    try:
-        client = genai.Client(api_key=GOOGLE_API_KEY)
-        response = await client.aio.models.generate_content(
-            model='gemma-3-27b-it',
+    return {"answer": ai_decision.get("reply_text", "Не совсем понял, сейчас позову менеджера."), "action": "chat"}
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/ai")
+async def ai_chat(q: Question, request: Request):
+    """Умный AI-помощник: Общение + Пересчет КП"""
+    await enforce_rate_limit("ai", request, q.proposal_id)
+    current_kp, prompt = await _start_question(q)
+    
+    async def decide(model_name: str) -> dict:
+        response = await genai_client.aio.models.generate_content(
+            model=model_name,
             contents=prompt,
             config=types.GenerateContentConfig(response_mime_type="application/json")
         )
-        ai_decision = json.loads(response.text)
-        
-        if ai_decision.get("action") == "recalculate":
-            new_task = ai_decision.get("new_task_context")
-            if new_task:
-                task_generate_proposal.delay(int(q.proposal_id), current_kp.get('client_name', 'Клиент'), new_task)
-                log_event(q.proposal_id, "recalculation_triggered", {"new_task": new_task})
-                notify(f"🔄 **Клиент запустил пересчет КП #{q.proposal_id}!**\nНовое ТЗ: {new_task}")
-                
-                return {
-                    "answer": ai_decision.get("reply_text", "Принял. Пересчитываю...") + " Страница обновится через 15-20 секунд.",
-                    "action": "recalculate"
-                }
-        
-        return {"answer": ai_decision.get("reply_text", "Не совсем понял, сейчас позову менеджера."), "action": "chat"}
+        return json.loads(response.text)
+
+    try:
+        ai_decision = await router.acall(ASSISTANT_MODELS, decide, hedge_delay=ASSISTANT_HEDGE_DELAY)
+        return await _apply_decision(q, current_kp, ai_decision)
         
     except Exception as e:
         logger.error(f"AI decision processing error: {e}")
-        return {"answer": "Ой, я немного запутался. Менеджер скоро свяжется с вами!", "action": "error"}
+        return {"answer": AI_ERROR_ANSWER, "action": "error"}
+
+@app.post("/ai/stream")
+async def ai_chat_stream(q: Question, request: Request):
+    """
+    Тот же помощник, но по SSE: события token несут куски reply_text по мере генерации,
+    финальное событие done — итоговый ответ и action (chat / recalculate / error).
+    """
+    await enforce_rate_limit("ai", request, q.proposal_id)
+    current_kp, prompt = await _start_question(q)
+
+    async def events():
+        parser = IncrementalJSONObject()
+        sent = 0
+        # Поток не хеджируется: берем самую быструю здоровую модель и отдаем замер роутеру
+        model_name = router.pick(ASSISTANT_MODELS)
+        started = time.perf_counter()
+        try:
+            stream = await genai_client.aio.models.generate_content_stream(
+                model=model_name,
+                contents=prompt,
+                config=types.GenerateContentConfig(response_mime_type="application/json")
+            )
+            async for chunk in stream:
+                if not chunk.text:
+                    continue
+                parser.feed(chunk.text)
+                reply = parser.partial_string("reply_text")
+                if reply and len(reply) > sent:
+                    yield _sse("token", {"text": reply[sent:]})
+                    sent = len(reply)
+            ai_decision = json.loads(parser.buffer)
+            router.record(model_name, time.perf_counter() - started, True)
+            yield _sse("done", await _apply_decision(q, current_kp, ai_decision))
+        except Exception as e:
+            router.record(model_name, time.perf_counter() - started, False)
+            logger.error(f"AI stream processing error: {e}")
+            yield _sse("done", {"answer": AI_ERROR_ANSWER, "action": "error"})
+
+    # X-Accel-Buffering: nginx не должен копить ответ, иначе токены придут одной пачкой
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/metrics/events")
+def events_metrics():
+    """Глубина очереди телеметрии и латентность записи пачек в SQLite"""
+    return event_buffer.stats()
+
+@app.get("/metrics/notifications")
+async def notifications_metrics():
+    """Счетчики диспетчера уведомлений менеджеру"""
+    return dispatcher.stats()
+
+@app.get("/metrics/caches")
+async def caches_metrics():
+    """Попадания/промахи общих кэшей (рыночные цены и т.д.)"""
+    counters = await get_cache_counters()
+    counters["rendered_pages"] = page_cache.stats()
+    return counters
+
+@app.get("/metrics/rate_limits")
+async def rate_limit_metrics():
+    """Отказы по лимитам, отброшенные дубли событий и переходы на локальный режим"""
+    return rate_limiter.stats()
+
+@app.get("/metrics/models")
+async def models_metrics():
+    """Латентность (p50/p95), доля ошибок и хеджи по моделям в этом процессе"""
+    return router.stats()
+
+@app.get("/proposals/{proposal_id}/analytics")
+async def proposal_analytics(proposal_id: int, request: Request):
+    """Вовлеченность клиента по КП: открытия, скролл, клики по тарифам, вопросы AI (только для менеджера)"""
+    require_manager(request)
+    analytics = await get_proposal_analytics(proposal_id)
+    if analytics is None:
+        raise HTTPException(status_code=404, detail="По этому КП еще нет событий")
+    return analytics
+
+@app.get("/p/{proposal_id}")
+async def proposal_page(proposal_id: int, request: Request):
+    """Страница КП напрямую из БД: LRU отрендеренного HTML + ETag/Last-Modified + gzip/brotli"""
+    meta = await get_proposal_version(proposal_id)
+    if not meta:
+        raise HTTPException(status_code=404, detail="КП не найдено или еще генерируется")
+    version, updated_at = meta
+    etag = page_etag(proposal_id, version, TEMPLATE_REV)
+    last_modified = http_date(updated_at)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+
+    # Условный запрос: версия не менялась — тело не нужно
+    if_none_match = request.headers.get("if-none-match")
+    if (if_none_match and etag in if_none_match) or (
+            not if_none_match and last_modified and request.headers.get("if-modified-since") == last_modified):
+        return Response(status_code=304, headers=headers)
+
+    page = page_cache.get(proposal_id, version)
+    if page is None:
+        data = await get_proposal_page_data(proposal_id)
+        if not data:
+            raise HTTPException(status_code=404, detail="КП не найдено или еще генерируется")
+        # Версия могла измениться между запросами — ключом служит то, что реально отрендерили
+        version = data["version"]
+        etag = headers["ETag"] = page_etag(proposal_id, version, TEMPLATE_REV)
+        html = await asyncio.to_thread(
+            render_page, proposal_id, data["client"], data["task"], data["proposal_data"], f"v{version}"
+        )
+        page = await asyncio.to_thread(RenderedPage, html, etag, http_date(data["updated_at"]))
+        page_cache.put(proposal_id, version, page)
+
+    encoding, body = page.body_for(request.headers.get("accept-encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="text/html; charset=utf-8", headers=headers)
 
 @app.get("/")
 def read_root():